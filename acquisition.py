@@ -0,0 +1,109 @@
+"""
+    Background camera acquisition for live imaging.
+
+    A producer thread drains the Micro-Manager sequence buffer into a fixed size,
+    preallocated ring of frames as fast as the camera delivers them, so slow
+    processing (YOLO, display) on the main thread never lets the camera buffer
+    overflow. The consumer takes the newest frame each time it is ready for one.
+
+    When the ring is full, the policy decides which frame is lost:
+        'drop-oldest'   overwrite the oldest unread frame (default, live view)
+        'drop-newest'   discard the incoming frame (keeps an unbroken run)
+"""
+import threading
+import time
+import numpy as np
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+
+
+class RingBuffer(object):
+    def __init__(self, slots, shape, dtype, policy=DROP_OLDEST):
+        if policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("policy must be '{}' or '{}'".format(DROP_OLDEST, DROP_NEWEST))
+        self.frames = np.zeros((slots,) + tuple(shape), dtype=dtype)
+        self.stamps = np.zeros(slots) # time.perf_counter() when each frame arrived
+        self.slots = slots
+        self.policy = policy
+        self.written = 0 # frames ever stored (sequence number of the next frame)
+        self.read = 0 # sequence number of the oldest unread frame
+        self.dropped = 0 # lost because the ring was full
+        self.skipped = 0 # stored, but passed over by pop_latest
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+
+    def __len__(self):
+        # number of unread frames
+        with self._lock:
+            return self.written - self.read
+
+    def put(self, frame, stamp=None):
+        # PURPOSE: copy a frame into the ring. Returns False if it was dropped (drop-newest, ring full).
+        with self._lock:
+            if self.written - self.read == self.slots:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return False
+                self.read += 1 # drop-oldest: its slot is overwritten below
+            i = self.written % self.slots
+            self.frames[i] = frame
+            self.stamps[i] = time.perf_counter() if stamp is None else stamp
+            self.written += 1
+            self._ready.notify_all()
+            return True
+
+    def _take(self, seq, out):
+        i = seq % self.slots
+        if out is None:
+            out = np.empty_like(self.frames[i])
+        np.copyto(out, self.frames[i])
+        return seq, self.stamps[i], out
+
+    def pop_latest(self, out=None, timeout=0):
+        # PURPOSE: return (seq, stamp, frame) for the newest frame and mark every older unread frame as skipped.
+        # Copies into out when given (no allocation). Returns None if nothing arrived within timeout seconds.
+        with self._lock:
+            if not self._ready.wait_for(lambda: self.written > self.read, timeout):
+                return None
+            seq = self.written - 1
+            self.skipped += seq - self.read
+            self.read = self.written
+            return self._take(seq, out)
+
+    def pop(self, out=None, timeout=0):
+        # PURPOSE: return (seq, stamp, frame) for the oldest unread frame (FIFO, e.g. for saving every frame)
+        with self._lock:
+            if not self._ready.wait_for(lambda: self.written > self.read, timeout):
+                return None
+            seq = self.read
+            self.read += 1
+            return self._take(seq, out)
+
+    def stats(self):
+        with self._lock:
+            return dict(written=self.written, dropped=self.dropped, skipped=self.skipped, unread=self.written - self.read)
+
+
+class AcquisitionThread(threading.Thread):
+    def __init__(self, mmc, ring, poll=.0005):
+        threading.Thread.__init__(self, daemon=True)
+        self.mmc = mmc
+        self.ring = ring
+        self.poll = poll # sleep when the camera has nothing new [s]
+        self.overflows = 0 # times the Micro-Manager buffer itself overflowed
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            if self.mmc.getRemainingImageCount() > 0:
+                self.ring.put(self.mmc.popNextImage())
+            else:
+                if self.mmc.isBufferOverflowed():
+                    self.overflows += 1
+                    self.mmc.clearCircularBuffer()
+                time.sleep(self.poll)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
@@ -0,0 +1,146 @@
+"""
+    Headless batch cell detection.
+
+    Streams every image in a directory (or every page of a TIFF stack) through
+    the same pipeline as the GUI's Find Cells button, spread over N worker
+    processes, and writes the centroids and blob stats of all frames to one CSV
+    or NPZ file per run.
+
+    usage: python batch_detect.py <directory or stack.tif> -o cells.csv -j 8
+"""
+import argparse
+import csv
+import os
+import sys
+from multiprocessing import Pool
+from os import listdir
+from os.path import isdir, isfile, join
+from timeit import default_timer as timer
+import cv2
+import numpy as np
+import tifffile as tiff
+from PIL import Image
+from detection import detect_cells
+from smoothing import BACKENDS
+from tiffstack import TiffStack
+
+IMAGE_EXTS = ('.tif', '.tiff', '.png', '.jpg', '.bmp')
+TIFF_EXTS = ('.tif', '.tiff')
+COLUMNS = ['filename', 'frame', 'cx', 'cy', 'area', 'radius', 'roundness', 'left', 'top', 'width', 'height']
+
+
+def list_frames(path):
+    # PURPOSE: expand a directory or stack into (file, page) tasks. Only TIFF headers are read here.
+    if isdir(path):
+        files = sorted(join(path, f) for f in listdir(path) if isfile(join(path, f)) and f.lower().endswith(IMAGE_EXTS))
+    else:
+        files = [path]
+    frames = list()
+    for f in files:
+        if f.lower().endswith(TIFF_EXTS):
+            with tiff.TiffFile(f) as t:
+                frames.extend((f, page) for page in range(len(t.pages)))
+        else:
+            frames.append((f, 0))
+    return frames
+
+
+_stack = None # TiffStack of the file this worker process read last, kept open so each page is a view, not a re-parse
+
+
+def read_frame(path, page, size=None):
+    global _stack
+    if path.lower().endswith(TIFF_EXTS):
+        if _stack is None or _stack.path != path: # tasks come in file order, one file open per worker
+            if _stack is not None:
+                _stack.close()
+            _stack = TiffStack(path, workers=1)
+        image = _stack[page]
+        if image.ndim == 3: # RGB(A) page
+            image = image[..., :3].mean(axis=-1)
+        if size is not None: # with PIL's default filter like other images; pages deeper than 8 bit as float
+            if image.dtype != np.uint8:
+                image = image.astype('float32')
+            image = np.array(Image.fromarray(image).resize(tuple(size)))
+        return image
+    image = Image.open(path).convert('L')
+    if size is not None: # e.g. the GUI's viewport size, resized as FrameSource does for the viewport
+        image = image.resize(tuple(size))
+    return np.array(image)
+
+
+def _init_worker():
+    cv2.setNumThreads(1) # one process per core already
+
+
+def _detect(args):
+    (path, page), settings = args
+    image = read_frame(path, page, settings['size'])
+    cells, labels = detect_cells(image, settings['threshold'], settings['scolor'], settings['sspace'], settings['smoothing'])
+    return path, page, cells
+
+
+def run(source, output, processes=None, threshold=97.0, scolor=.034, sspace=.019, size=None, smoothing='bilateral'):
+    # PURPOSE: detect cells in every frame of source and write one output file. Returns (frames, cells, seconds).
+    frames = list_frames(source)
+    settings = dict(threshold=threshold, scolor=scolor, sspace=sspace, size=size, smoothing=smoothing)
+    tasks = [(f, settings) for f in frames]
+    as_npz = output.lower().endswith('.npz')
+    columns = {c: list() for c in COLUMNS}
+    n_cells = 0
+
+    out = None if as_npz else open(output, 'w', newline='')
+    start = timer()
+    try:
+        if out is not None:
+            writer = csv.writer(out)
+            writer.writerow(COLUMNS)
+        with Pool(processes, initializer=_init_worker) as pool:
+            for i, (path, page, cells) in enumerate(pool.imap(_detect, tasks, chunksize=4)):
+                n_cells += len(cells)
+                name = os.path.relpath(path, source) if isdir(source) else os.path.basename(path)
+                if as_npz:
+                    columns['filename'].append(np.full(len(cells), name, dtype=object))
+                    columns['frame'].append(np.full(len(cells), page, dtype='i4'))
+                    for c in COLUMNS[2:]:
+                        columns[c].append(cells[c])
+                else:
+                    for c in cells:
+                        writer.writerow([name, page, '%.2f' % c['cx'], '%.2f' % c['cy'], '%.1f' % c['area'], '%.2f' % c['radius'],
+                                         '%.3f' % c['roundness'], c['left'], c['top'], c['width'], c['height']])
+                if (i + 1) % 100 == 0:
+                    print('{} / {} frames, {:.1f} frames/s'.format(i + 1, len(tasks), (i + 1)/(timer() - start)))
+    finally:
+        if out is not None:
+            out.close()
+    seconds = timer() - start
+
+    if as_npz:
+        arrays = {c: np.concatenate(v) if v else np.zeros(0) for c, v in columns.items()}
+        arrays['filename'] = arrays['filename'].astype(str)
+        np.savez(output, **arrays)
+    return len(tasks), n_cells, seconds
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Detect fluorescent cells in every image of a directory or TIFF stack.')
+    parser.add_argument('source', help='directory of images or a (multi-page) TIFF file')
+    parser.add_argument('-o', '--output', default='cells.csv', help='output file, .csv or .npz (default: cells.csv)')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--threshold', type=float, default=97.0, help='threshold percentile (default: 97)')
+    parser.add_argument('--scolor', type=float, default=.034, help='color blending, fraction of image height (default: .034)')
+    parser.add_argument('--sspace', type=float, default=.019, help='spatial blending, fraction of image height (default: .019)')
+    parser.add_argument('--size', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'), default=None,
+                        help='resize frames before detection, e.g. 550 550 to match the GUI viewport')
+    parser.add_argument('--smoothing', choices=BACKENDS, default='bilateral',
+                        help='filter backend: exact bilateral, or the faster downsampled/guided approximations (default: bilateral)')
+    args = parser.parse_args(argv)
+
+    if not (isdir(args.source) or isfile(args.source)):
+        parser.error('no such file or directory: ' + args.source)
+    frames, cells, seconds = run(args.source, args.output, args.processes, args.threshold, args.scolor, args.sspace, args.size, args.smoothing)
+    print('{} frames, {} cells in {:.1f} s ({:.1f} frames/s) -> {}'.format(frames, cells, seconds, frames/max(seconds, 1e-9), args.output))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""
+    Lookup-table contrast stretch for camera frames.
+
+    Maps [min, max] input intensities linearly onto 0-255 (clipped) for display
+    and YOLO input. The table is built once per (min, max, bit depth) and applied
+    with one gather (cv2.LUT for 8-bit frames), so a 1280x1024 frame costs a
+    memory pass instead of a float64 expression per pixel.
+
+    Run this file to benchmark against the old contrastStretch.
+"""
+import cv2
+import numpy as np
+
+
+def build_lut(min, max, bit_depth=8):
+    # PURPOSE: table mapping every possible input value to its stretched, clipped uint8 output
+    levels = np.arange(2**bit_depth, dtype='float64')
+    scale = 255./(max - min) if max != min else 0.
+    return np.clip(np.rint((levels - min)*scale), 0, 255).astype('uint8')
+
+
+class ContrastStretch(object):
+    def __init__(self, min, max):
+        self.min = min
+        self.max = max
+        self._lut = None
+        self._key = None
+
+    def set_range(self, min, max):
+        self.min = min
+        self.max = max
+
+    def lut(self, dtype):
+        bit_depth = 8*np.dtype(dtype).itemsize
+        if np.dtype(dtype).kind != 'u' or bit_depth > 16:
+            raise ValueError('contrast stretch needs uint8 or uint16 frames, got ' + str(np.dtype(dtype)))
+        key = (self.min, self.max, bit_depth)
+        if key != self._key: # only rebuilt when the range (or frame type) changes
+            self._lut = build_lut(self.min, self.max, bit_depth)
+            self._key = key
+        return self._lut
+
+    def __call__(self, frame, out=None):
+        # PURPOSE: stretch a uint8/uint16 frame to uint8. Writes into out when given.
+        lut = self.lut(frame.dtype)
+        if frame.dtype == np.uint8:
+            return cv2.LUT(frame, lut, dst=out)
+        if out is None:
+            out = np.empty(frame.shape, dtype='uint8')
+        np.take(lut, frame, out=out)
+        return out
+
+
+if __name__ == '__main__':
+    from timeit import default_timer as timer
+
+    def contrastStretch(image, min, max):
+        # the function this module replaces (liveImaging_um.py)
+        iI = image
+        minI = min
+        maxI = max
+        minO = 0
+        maxO = 255
+        iO = (iI - minI) * (((maxO - minO) / (maxI - minI)) + minO)
+        return iO
+
+    def bench(f, reps=20):
+        f()
+        start = timer()
+        for i in range(reps):
+            f()
+        return 1e3*(timer() - start)/reps
+
+    M, N = 1280, 1024
+    rng = np.random.default_rng(0)
+    stretch = ContrastStretch(55, 80)
+    for dtype, hi in [('uint8', 256), ('uint16', 4096)]:
+        frame = rng.integers(0, hi, (N, M)).astype(dtype)
+        out = np.empty((N, M), 'uint8')
+        t_old = bench(lambda: np.uint8(contrastStretch(frame, 55, 80)))
+        t_clip = bench(lambda: np.uint8(np.clip(contrastStretch(frame, 55, 80), 0, 255)))
+        t_lut = bench(lambda: stretch(frame, out))
+        print('{:>6}: contrastStretch {:6.2f} ms   (+clip {:6.2f} ms)   LUT {:6.2f} ms   ({:.0f}x vs +clip)'.format(
+            dtype, t_old, t_clip, t_lut, t_clip/t_lut))
+    small = rng.integers(0, 256, (64, 64)).astype('uint8')
+    t_vec = bench(lambda: np.vectorize(contrastStretch)(small, 55, 80), reps=3)*(M*N)/(64*64)
+    print('np.vectorize(contrastStretch), extrapolated to a full frame: {:.0f} ms'.format(t_vec))
+
+    # the old expression wraps around instead of clipping
+    values = np.array([40, 55, 80, 120], 'uint8')
+    print('input      ', values)
+    print('old uint8  ', np.uint8(contrastStretch(values.astype(float), 55, 80)))
+    print('LUT        ', stretch(values))
@@ -0,0 +1,147 @@
+"""
+    Min/max decimation for plotting long ephys traces.
+
+    MinMaxPyramid is built once per channel: level 1 holds the min and max of
+    every `block` samples, each level above reduces the one below by `factor`.
+    A query for a sample range returns at most max_points values, merged from the
+    nearest level (raw samples when zoomed in far enough). Each bin
+    contributes its min and max, so spikes and other short excursions stay
+    visible at any zoom.
+
+    DecimatedLine keeps a matplotlib line in step with its axes: on every
+    xlim change (toolbar pan/zoom) or canvas resize it re-queries about two
+    points per horizontal pixel.
+
+    The pyramid is built in chunks, so data can be a np.memmap larger than RAM.
+    Run this file to benchmark against plotting every sample.
+"""
+import numpy as np
+
+
+class MinMaxPyramid(object):
+    def __init__(self, data, block=16, factor=4, chunk=1 << 20, top=1024):
+        self.data = data
+        self.n = len(data)
+        self.factor = factor
+        self.levels = [] # (bin size in samples, mins, maxs), finest first
+        chunk = max(block, chunk//block*block)
+        bins = -(-self.n//block)
+        dtype = np.asarray(data[:1]).dtype
+        mins = np.empty(bins, dtype=dtype)
+        maxs = np.empty(bins, dtype=dtype)
+        for start in range(0, self.n, chunk):
+            samples = np.asarray(data[start:start + chunk])
+            starts = np.arange(0, len(samples), block)
+            mins[start//block:start//block + len(starts)] = np.minimum.reduceat(samples, starts)
+            maxs[start//block:start//block + len(starts)] = np.maximum.reduceat(samples, starts)
+        size = block
+        self.levels.append((size, mins, maxs))
+        while len(mins) > top:
+            starts = np.arange(0, len(mins), factor)
+            mins = np.minimum.reduceat(mins, starts)
+            maxs = np.maximum.reduceat(maxs, starts)
+            size *= factor
+            self.levels.append((size, mins, maxs))
+
+    def extent(self):
+        # (min, max) of the whole trace
+        size, mins, maxs = self.levels[-1]
+        return mins.min(), maxs.max()
+
+    def query(self, start, stop, max_points):
+        # PURPOSE: (x in samples, y) covering samples [start, stop) in at most max_points points
+        start = int(min(max(start, 0), self.n))
+        stop = int(min(max(np.ceil(stop), start), self.n))
+        if stop - start <= max_points:
+            return np.arange(start, stop), np.asarray(self.data[start:stop])
+        for size, mins, maxs in self.levels: # finest level within one factor of the target
+            first, last = start//size, -(-stop//size)
+            if 2*(last - first) <= max_points*self.factor:
+                break
+        mins, maxs = mins[first:last], maxs[first:last]
+        merge = -(-2*len(mins)//max_points) # then merge bins of that level to fit max_points
+        if merge > 1:
+            starts = np.arange(0, len(mins), merge)
+            mins, maxs = np.minimum.reduceat(mins, starts), np.maximum.reduceat(maxs, starts)
+        x = np.repeat(first*size + (np.arange(len(mins)) + .5)*merge*size, 2)
+        y = np.empty(2*len(mins), dtype=mins.dtype)
+        y[0::2] = mins
+        y[1::2] = maxs
+        return x, y
+
+
+class DecimatedLine(object):
+    def __init__(self, ax, pyramid, rate, t0=0., **kwargs):
+        # rate: samples per second; t0: time of the first sample [s]. kwargs go to ax.plot.
+        self.ax = ax
+        self.pyramid = pyramid
+        self.rate = float(rate)
+        self.t0 = t0
+        self.line, = ax.plot([], [], **kwargs)
+        self._xlim_cid = ax.callbacks.connect('xlim_changed', self.update)
+        self._resize_cid = ax.figure.canvas.mpl_connect('resize_event', self._resized)
+        self.update()
+
+    def update(self, ax=None):
+        # PURPOSE: re-query the pyramid for the visible time range, ~2 points per pixel
+        lo, hi = self.ax.get_xlim()
+        width = max(1, int(self.ax.bbox.width))
+        x, y = self.pyramid.query((lo - self.t0)*self.rate, (hi - self.t0)*self.rate + 1, 2*width)
+        self.line.set_data(self.t0 + x/self.rate, y)
+
+    def _resized(self, event):
+        self.update()
+        self.ax.figure.canvas.draw_idle()
+
+    def remove(self):
+        self.ax.callbacks.disconnect(self._xlim_cid)
+        self.ax.figure.canvas.mpl_disconnect(self._resize_cid)
+        self.line.remove()
+
+
+if __name__ == '__main__':
+    from timeit import default_timer as timer
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    rate = 20000
+    n = rate*300 # 5 minute gap-free sweep
+    rng = np.random.default_rng(0)
+    trace = (rng.normal(-65, 1, n) + 40*(rng.random(n) < 2e-5)).astype('float32') # noise with rare 'spikes'
+
+    start = timer()
+    pyramid = MinMaxPyramid(trace)
+    print('{:.1f} M samples, pyramid: {} levels, built in {:.0f} ms'.format(n/1e6, len(pyramid.levels), 1e3*(timer() - start)))
+
+    def draw_time(fig, reps=3):
+        fig.canvas.draw()
+        start = timer()
+        for i in range(reps):
+            fig.canvas.draw()
+        return 1e3*(timer() - start)/reps
+
+    fig = Figure(figsize=(5, 4), dpi=100)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    line = DecimatedLine(ax, pyramid, rate)
+    ax.set_xlim(0, n/rate)
+    ax.set_ylim(*pyramid.extent())
+    print('decimated, full view: {} points, draw {:.1f} ms'.format(len(line.line.get_xdata()), draw_time(fig)))
+    for span in (10., .1, .005):
+        start = timer()
+        ax.set_xlim(100, 100 + span)
+        t_query = 1e3*(timer() - start)
+        print('decimated, {:g} s view: {} points, query {:.2f} ms, draw {:.1f} ms'.format(
+            span, len(line.line.get_xdata()), t_query, draw_time(fig)))
+
+    # spikes survive decimation
+    x, y = pyramid.query(0, n, 2*int(ax.bbox.width))
+    print('max of trace {:.1f}, of decimated view {:.1f}'.format(trace.max(), y.max()))
+
+    fig = Figure(figsize=(5, 4), dpi=100)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.plot(np.arange(n)/rate, trace)
+    print('ax.plot of every sample, full view: draw {:.0f} ms'.format(draw_time(fig, reps=1)))
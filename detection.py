@@ -0,0 +1,297 @@
+"""
+    Fluorescent cell detection core.
+
+    Labels every thresholded blob in one pass (connected components), drops the
+    ones too small to be a cell from their bounding boxes alone, and measures
+    only the rest (outer contour, enclosing circle), instead of looping over
+    every contour in Python. Returns the candidates as a structured array.
+    Shared by the GUI (idFluorescentCells), testing.py and filtering.py.
+
+    Run this file to benchmark against the old per-contour loop.
+"""
+import cv2
+import numpy as np
+from smoothing import smooth
+from threshold import level_and_scale
+
+# One row per connected component. cx, cy are the centroid of its outer contour
+# (cv2.moments, truncated to whole pixels like the old loop); area and radius are
+# cv2.contourArea and the cv2.minEnclosingCircle radius of that contour;
+# roundness = area / (pi * radius^2).
+CELL_DTYPE = np.dtype([
+    ('label', 'i4'),
+    ('cx', 'f4'),
+    ('cy', 'f4'),
+    ('area', 'f4'),
+    ('radius', 'f4'),
+    ('roundness', 'f4'),
+    ('left', 'i4'),
+    ('top', 'i4'),
+    ('width', 'i4'),
+    ('height', 'i4'),
+])
+
+# Cell criteria used by the GUI: contour size between .05% and 1% of the field
+# of view, and area at least half of the enclosing circle.
+MIN_AREA_FRAC = .0005
+MAX_AREA_FRAC = .01
+MIN_ROUNDNESS = .5
+
+
+def measure_components(mask, min_area=0):
+    # PURPOSE: label a binary mask and measure its components in one pass. Returns (candidates, labels).
+    # Components whose bounding box is not larger than min_area pixels are dropped before the (costlier) contour
+    # measurement: their contour area cannot be larger either. max_area is applied by select_cells.
+    mask = mask.astype('uint8', copy=False)
+    n, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    keep = stats[:, cv2.CC_STAT_WIDTH]*stats[:, cv2.CC_STAT_HEIGHT] > min_area
+    keep[0] = False # label 0 is background
+    idx = np.flatnonzero(keep)
+
+    candidates = np.zeros(len(idx), dtype=CELL_DTYPE)
+    if len(idx) == 0:
+        return candidates, labels
+    candidates['label'] = idx
+    candidates['left'] = stats[idx, cv2.CC_STAT_LEFT]
+    candidates['top'] = stats[idx, cv2.CC_STAT_TOP]
+    candidates['width'] = stats[idx, cv2.CC_STAT_WIDTH]
+    candidates['height'] = stats[idx, cv2.CC_STAT_HEIGHT]
+
+    # centroid, minimum enclosing circle and area of the outer contour, as the per-contour loop measured them: the
+    # contour area runs through the outline pixel centers and includes holes, so it is not the pixel count. Only
+    # the components left after the size cut are traced, each in its own bounding box.
+    outer = np.ones(len(idx), dtype=bool)
+    contours = []
+    for i, (label, left, top, width, height) in enumerate(zip(idx, candidates['left'], candidates['top'],
+                                                              candidates['width'], candidates['height'])):
+        crop = (labels[top:top + height, left:left + width] == label).astype('uint8')
+        cnt, hierarchy = cv2.findContours(crop, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE,
+                                          offset=(int(left), int(top)))
+        cnt = max(cnt, key=len) # an 8-connected component has one outer contour
+        (x, y), candidates['radius'][i] = cv2.minEnclosingCircle(cnt)
+        candidates['area'][i] = cv2.contourArea(cnt)
+        M = cv2.moments(cnt)
+        if M['m00'] > 0:
+            candidates['cx'][i] = int(M['m10']/M['m00'])
+            candidates['cy'][i] = int(M['m01']/M['m00'])
+        else: # a one pixel wide line has no contour area (and is never a cell): pixel centroid
+            candidates['cx'][i], candidates['cy'][i] = centroids[label]
+        contours.append(cnt)
+    # a component inside the hole of another one has no outer contour of its own (RETR_EXTERNAL skips it)
+    right, bottom = candidates['left'] + candidates['width'], candidates['top'] + candidates['height']
+    inside = ((candidates['left'][:, None] > candidates['left'][None]) &
+              (candidates['top'][:, None] > candidates['top'][None]) &
+              (right[:, None] < right[None]) & (bottom[:, None] < bottom[None]))
+    for i, j in zip(*np.nonzero(inside)):
+        point = tuple(float(v) for v in contours[i][0, 0])
+        if outer[i] and cv2.pointPolygonTest(contours[j], point, False) > 0:
+            outer[i] = False
+    radius = candidates['radius']
+    candidates['roundness'] = candidates['area'] / (np.pi*radius*radius)
+    candidates = candidates[outer]
+    return candidates, labels
+
+
+def select_cells(candidates, shape, min_area_frac=MIN_AREA_FRAC, max_area_frac=MAX_AREA_FRAC,
+                 min_roundness=MIN_ROUNDNESS):
+    # PURPOSE: keep candidates whose size and roundness look like a cell
+    row, col = shape[:2]
+    area = candidates['area']
+    keep = (area < max_area_frac*row*col) & (area > min_area_frac*row*col) & (candidates['roundness'] > min_roundness)
+    return candidates[keep]
+
+
+def find_cells(mask, min_area_frac=MIN_AREA_FRAC, max_area_frac=MAX_AREA_FRAC, min_roundness=MIN_ROUNDNESS):
+    # PURPOSE: measure the blobs of a thresholded image and return (cells, labels)
+    row, col = mask.shape[:2]
+    candidates, labels = measure_components(mask, min_area=min_area_frac*row*col)
+    return select_cells(candidates, mask.shape, min_area_frac, max_area_frac, min_roundness), labels
+
+
+def detect_cells(image, threshold_perc=97.0, scolor=.034, sspace=.019, smoothing='bilateral', **criteria):
+    # PURPOSE: same pipeline as the GUI: normalize, bilateral filter, threshold at a percentile, find cells.
+    # scolor/sspace are fractions of the image height; smoothing picks the filter backend (smoothing.py).
+    # Returns (cells, labels).
+    # Works in raw units: the percentile and the maximum come from one histogram of the integer frame
+    # (threshold.py) and the filter is scaled instead of normalizing a float copy of the frame.
+    row, col = image.shape[:2]
+    level, scale = level_and_scale(image, threshold_perc/100)
+    bilateral_filtered_image = smooth(image, row, scolor, sspace, smoothing, scale=scale)
+    ret, masked_image = cv2.threshold(bilateral_filtered_image, level, 1, cv2.THRESH_BINARY)
+    return find_cells(masked_image, **criteria)
+
+
+class IncrementalDetector(object):
+    # detect_cells for a stream of frames of one field of view. After a full pass, a coarse (1/coarse resolution)
+    # view of each new frame is compared with the last segmented one, and the frame is filtered and thresholded
+    # only where it changed, in windows around the known cells there; the rest of the mask is kept. The threshold
+    # level and normalization of the last full pass are kept too. A full pass runs on the first frame, on a size
+    # change and when more than full_fraction of the frame would have to be redone.
+    def __init__(self, threshold_perc=97.0, scolor=.034, sspace=.019, smoothing='bilateral', coarse=16, change=.05,
+                 margin=.5, full_fraction=.5, **criteria):
+        # change: coarse pixel difference (fraction of the normalization maximum) that counts as changed.
+        # margin: window around a known cell, as a fraction of its size, for cells that moved.
+        self.settings = (threshold_perc, scolor, sspace, smoothing)
+        self.coarse = coarse
+        self.change = change
+        self.margin = margin
+        self.full_fraction = full_fraction
+        self.criteria = criteria
+        self.full_passes = 0
+        self.incremental_passes = 0
+        self.redone = 1. # fraction of the last frame that was filtered
+        self._mask = None
+
+    def reset(self):
+        # the next frame gets a full pass
+        self._mask = None
+
+    def _thumbnail(self, image):
+        h, w = image.shape[:2]
+        return cv2.resize(image.astype('float32', copy=False), (-(-w//self.coarse), -(-h//self.coarse)),
+                          interpolation=cv2.INTER_AREA)/self._scale
+
+    def _full(self, image):
+        threshold_perc, scolor, sspace, smoothing = self.settings
+        self._level, self._scale = level_and_scale(image, threshold_perc/100) # raw units
+        self._scale = float(self._scale)
+        filtered = smooth(image, image.shape[0], scolor, sspace, smoothing, scale=self._scale)
+        ret, self._mask = cv2.threshold(filtered, self._level, 1, cv2.THRESH_BINARY)
+        self._mask = self._mask.astype('uint8')
+        self._thumb = self._thumbnail(image)
+        self.full_passes += 1
+        self.redone = 1.
+
+    def _dirty(self, image, cells):
+        # tiles (coarse x coarse px) to redo: changed ones and their neighbours, and the windows of known cells
+        # that touch them
+        thumb = self._thumbnail(image)
+        changed = (np.abs(thumb - self._thumb) > self.change).astype('uint8')
+        dirty = cv2.dilate(changed, np.ones((3, 3), 'uint8')) # a new cell can reach past the changed tiles
+        c = self.coarse
+        pad_x = np.ceil(self.margin*cells['width'])
+        pad_y = np.ceil(self.margin*cells['height'])
+        x0 = ((cells['left'] - pad_x)//c).clip(0).astype(int)
+        y0 = ((cells['top'] - pad_y)//c).clip(0).astype(int)
+        x1 = ((cells['left'] + cells['width'] + pad_x)//c + 1).astype(int)
+        y1 = ((cells['top'] + cells['height'] + pad_y)//c + 1).astype(int)
+        for a, b, e, f in zip(y0, y1, x0, x1):
+            if changed[a:b, e:f].any():
+                dirty[a:b, e:f] = 1
+        return dirty, thumb
+
+    def detect(self, image):
+        # PURPOSE: (cells, labels) of a new frame, like detect_cells
+        threshold_perc, scolor, sspace, smoothing = self.settings
+        if self._mask is None or self._mask.shape != image.shape[:2]:
+            self._full(image)
+        else:
+            dirty, thumb = self._dirty(image, self.cells)
+            self.redone = dirty.mean()
+            if self.redone > self.full_fraction:
+                self._full(image)
+            else:
+                self.incremental_passes += 1
+                row, col = image.shape[:2]
+                pad = int(scolor*row)//2 + 1 # filter radius: context the window needs around it
+                n, tiles, stats, centroids = cv2.connectedComponentsWithStats(dirty, connectivity=8)
+                c = self.coarse
+                for left, top, width, height, area in stats[1:]:
+                    x0, y0 = left*c, top*c
+                    x1, y1 = min((left + width)*c, col), min((top + height)*c, row)
+                    px0, py0 = max(x0 - pad, 0), max(y0 - pad, 0)
+                    crop = image[py0:min(y1 + pad, row), px0:min(x1 + pad, col)]
+                    filtered = smooth(crop, row, scolor, sspace, smoothing, scale=self._scale)
+                    self._mask[y0:y1, x0:x1] = filtered[y0 - py0:y1 - py0, x0 - px0:x1 - px0] > self._level
+                    self._thumb[top:top + height, left:left + width] = thumb[top:top + height, left:left + width]
+        self.cells, labels = find_cells(self._mask, **self.criteria)
+        return self.cells, labels
+
+
+def draw_cells(image, cells, labels, color=200, linewidth=2, markers=True):
+    # PURPOSE: draw the outline (and centroid marker) of every detected cell onto image, in place
+    if len(cells) == 0:
+        return image
+    lut = np.zeros(labels.max() + 1, dtype='uint8')
+    lut[cells['label']] = 1
+    contours, hierarchy = cv2.findContours(lut[labels], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    cv2.drawContours(image, contours, -1, color, linewidth)
+    if markers:
+        for cx, cy in zip(np.rint(cells['cx']).astype(int), np.rint(cells['cy']).astype(int)):
+            cv2.drawMarker(image, (int(cx), int(cy)), color, cv2.MARKER_CROSS, 10, 1)
+    return image
+
+
+if __name__ == '__main__':
+    from timeit import default_timer as timer
+
+    def contour_loop(mask):
+        # the loop this module replaces (idFluorescentCells before the detection core)
+        row, col = mask.shape
+        contours, hierarchy = cv2.findContours(mask.astype('uint8'), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        centroids = list()
+        for cnt in contours:
+            (x,y),radius = cv2.minEnclosingCircle(cnt)
+            if cv2.contourArea(cnt) < .01*row*col and cv2.contourArea(cnt) > .0005*row*col and cv2.contourArea(cnt) > (radius*radius*3.1415*.5):
+                M = cv2.moments(cnt)
+                centroids.append([int(M['m10']/M['m00']), int(M['m01']/M['m00'])])
+        return centroids
+
+    # a few hundred cell sized discs over an increasing number of small noise blobs
+    reps = 5
+    row, col = 1024, 1280
+    print('{:>8} {:>12} {:>12} {:>8}'.format('blobs', 'loop [ms]', 'batch [ms]', 'speedup'))
+    for noise in [.005, .01, .02, .03]:
+        rng = np.random.default_rng(0)
+        mask = (rng.random((row, col)) < noise).astype('uint8')
+        for cx, cy in zip(rng.integers(30, col - 30, 300), rng.integers(30, row - 30, 300)):
+            cv2.circle(mask, (int(cx), int(cy)), int(rng.integers(15, 25)), 1, -1)
+
+        start = timer()
+        for i in range(reps):
+            old = contour_loop(mask)
+        t_loop = (timer() - start)/reps
+        start = timer()
+        for i in range(reps):
+            cells, labels = find_cells(mask)
+        t_batch = (timer() - start)/reps
+        blobs = cv2.connectedComponents(mask)[0] - 1
+        print('{:>8} {:>12.1f} {:>12.1f} {:>7.1f}x   ({} vs {} cells)'.format(blobs, 1e3*t_loop, 1e3*t_batch,
+                                                                      t_loop/t_batch, len(old), len(cells)))
+
+    # live frames: 20 cells on a noisy 1280x1024 background, one moving and one brightening per frame
+    def render(centers, brightness, rng):
+        frame = rng.normal(500, 30, (row, col)).astype('float32')
+        for (cx, cy), b in zip(centers, brightness):
+            cv2.circle(frame, (int(cx), int(cy)), 18, float(500 + b), -1)
+        return cv2.GaussianBlur(frame, (0, 0), 3).clip(0, 65535).astype('uint16')
+
+    rng = np.random.default_rng(1)
+    centers = np.column_stack([rng.uniform(60, col - 60, 20), rng.uniform(60, row - 60, 20)])
+    brightness = rng.uniform(1500, 3000, 20)
+    frames = []
+    for i in range(6):
+        frames.append(render(centers, brightness, rng))
+        centers[rng.integers(20)] += rng.normal(0, 4, 2)
+        brightness[rng.integers(20)] *= 1.3
+    detector = IncrementalDetector()
+    detector.detect(frames[0]) # full pass
+    t_full, t_incremental, differ, redone = 0, 0, 0, 0
+    for frame in frames[1:]:
+        start = timer()
+        full, labels = detect_cells(frame)
+        t_full += timer() - start
+        start = timer()
+        cells, labels = detector.detect(frame)
+        t_incremental += timer() - start
+        redone += detector.redone
+        # centroids are truncated to whole pixels: a sub-pixel shift can move them by one pixel on each axis
+        d = np.hypot(full['cx'][:, None] - cells['cx'][None], full['cy'][:, None] - cells['cy'][None])
+        differ += abs(len(full) - len(cells)) + int(np.sum(d.min(1) > 1.5)) if len(cells) else len(full)
+    n = len(frames) - 1
+    print('\n{} live frames {}x{}, {} cells: detect_cells {:.0f} ms/frame, IncrementalDetector {:.0f} ms/frame '
+          '(redid {:.1%} of the frame on average, {} cells differ)'.format(
+          n, col, row, len(cells), 1e3*t_full/n, 1e3*t_incremental/n, redone/n, differ))
+    start = timer()
+    detector.detect(frames[-1])
+    print('unchanged frame: {:.0f} ms'.format(1e3*(timer() - start)))
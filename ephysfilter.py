@@ -0,0 +1,99 @@
+"""
+    Streaming filter chain for live ephys display.
+
+    High-pass, notch and low-pass stages are combined into one array of
+    second-order sections and run with scipy.signal.sosfilt, carrying the filter
+    state (zi) from one chunk to the next, so filtering a recording chunk by
+    chunk gives exactly the same samples as filtering it in one go (offline()).
+
+    The state starts at the steady state for the first sample, like a trace
+    that had been sitting at that value, so there is no turn-on transient.
+    Output and state buffers are allocated once; sosfilt itself still makes a
+    working copy of each chunk.
+
+    Run this file for chunk latency and throughput.
+"""
+import numpy as np
+import scipy.signal as sig
+
+
+class FilterChain(object):
+    def __init__(self, rate, lowpass=None, notch=None, highpass=None, order=4, notch_q=30., channels=None, chunk=1024):
+        # cutoffs in Hz (None skips the stage); channels=None for 1D chunks, else chunks are (channels, samples)
+        self.rate = rate
+        sections = []
+        if highpass:
+            sections.append(sig.butter(order, highpass, 'highpass', fs=rate, output='sos'))
+        if notch:
+            b, a = sig.iirnotch(notch, notch_q, fs=rate)
+            sections.append(sig.tf2sos(b, a))
+        if lowpass:
+            sections.append(sig.butter(order, lowpass, 'lowpass', fs=rate, output='sos'))
+        self.sos = np.vstack(sections) if sections else np.array([[1., 0., 0., 1., 0., 0.]]) # pass through
+        shape = (len(self.sos), 2) if channels is None else (len(self.sos), channels, 2)
+        self.zi = np.zeros(shape) # carried state, updated in place
+        self._zi_steady = sig.sosfilt_zi(self.sos) # state for a unit step, scaled by the first sample
+        self._out = np.empty(chunk if channels is None else (channels, chunk))
+        self._primed = False
+
+    def reset(self):
+        # the next chunk starts a new trace
+        self._primed = False
+
+    def initial_state(self, first):
+        # PURPOSE: steady state zi for a trace starting at `first` (scalar, or one value per channel)
+        first = np.asarray(first, dtype='float64')
+        return self._zi_steady.reshape(self._zi_steady.shape[:1] + (1,)*first.ndim + (2,))*first[..., None]
+
+    def process(self, chunk, out=None):
+        # PURPOSE: filter the next chunk (samples along the last axis). Writes into out when given, otherwise into
+        # a buffer reused by the next call (copy it to keep it).
+        if not self._primed:
+            self.zi[...] = self.initial_state(chunk[..., 0])
+            self._primed = True
+        y, zf = sig.sosfilt(self.sos, chunk, zi=self.zi)
+        self.zi[...] = zf
+        if out is None:
+            if self._out.shape[-1] < chunk.shape[-1]:
+                self._out = np.empty(chunk.shape)
+            out = self._out[..., :chunk.shape[-1]]
+        out[...] = y
+        return out
+
+    def offline(self, x):
+        # PURPOSE: the whole trace in one call, same result as process() chunk by chunk
+        return sig.sosfilt(self.sos, x, zi=self.initial_state(np.asarray(x)[..., 0]))[0]
+
+
+if __name__ == '__main__':
+    from timeit import default_timer as timer
+
+    rate = 20000
+    seconds = 60
+    rng = np.random.default_rng(0)
+    t = np.arange(seconds*rate)/rate
+    trace = -65 + 2*np.sin(2*np.pi*60*t) + rng.normal(0, .5, len(t)) # resting potential, mains hum, noise
+
+    chain = FilterChain(rate, lowpass=5000., notch=60., highpass=1.)
+    print('{} second-order sections'.format(len(chain.sos)))
+    start = timer()
+    reference = chain.offline(trace)
+    t_offline = timer() - start
+    print('offline: {:.0f} ms for {} s ({:.0f}x real time)'.format(1e3*t_offline, seconds, seconds/t_offline))
+
+    for size in (64, 256, 1024, 4096):
+        chain = FilterChain(rate, lowpass=5000., notch=60., highpass=1., chunk=size)
+        filtered = np.empty_like(trace)
+        latency = []
+        for i in range(0, len(trace), size):
+            start = timer()
+            chain.process(trace[i:i + size], out=filtered[i:i + size])
+            latency.append(timer() - start)
+        latency = 1e6*np.array(latency)
+        print('chunks of {:5d} ({:5.1f} ms): latency {:7.1f} us mean, {:7.1f} us p99, {:5.0f}x real time, max |chunked - offline| = {:.1e}'.format(
+            size, 1e3*size/rate, latency.mean(), np.percentile(latency, 99), seconds/(1e-6*latency.sum()), np.abs(filtered - reference).max()))
+
+    # mains hum removed, resting potential kept by a chain without high-pass
+    chain = FilterChain(rate, lowpass=5000., notch=60.)
+    hum = np.abs(np.fft.rfft(chain.offline(trace)[rate:] + 65))[60*(seconds - 1)]/(rate*(seconds - 1)/2)
+    print('60 Hz amplitude 2 mV --> {:.3f} mV after the notch, mean {:.2f} mV'.format(hum, chain.offline(trace).mean()))
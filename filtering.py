@@ -1,41 +1,42 @@
-import cv2
 import numpy as np
 from PIL import Image
 import matplotlib.pyplot as plt
 import tifffile as tiff
+from sweep import sweep, print_table
 
-raw_image = tiff.imread("4.tif")
-norm_image = raw_image/np.max(raw_image)
-row,col = norm_image.shape
-plt.imshow(norm_image)
-
+# Parameter grids to sweep: bilateral diameter (fraction of image height), sigmaColor, sigmaSpace, threshold quantile
+diameterFracs = [.019,.024]
 sigmaColors = [10,15,20]
 sigmaSpaces = [10,15,20]
+quantiles = [.95,.97,.99]
+
+if __name__ == '__main__': # needed for the process pool on Windows
+    raw_image = tiff.imread("4.tif")
+    row,col = raw_image.shape
 
-count = 0
-plt.figure(figsize=(8,8))
-for i in range(3):
-    for j in range(3):
-        bilateral_filtered_image = cv2.bilateralFilter(norm_image.astype('float32'), int(.024*row), sigmaColors[i], sigmaSpaces[j])
-        ret, masked_image = cv2.threshold(bilateral_filtered_image,np.quantile(norm_image,.97),1,cv2.THRESH_BINARY)
-        contours, hierarchy = cv2.findContours(masked_image.astype('uint8'),cv2.RETR_LIST,cv2.CHAIN_APPROX_NONE)
-        
-        # centroids = list()
-        for cnt in contours:
-            (x,y),radius = cv2.minEnclosingCircle(cnt)
-            if cv2.contourArea(cnt) < 8000 and cv2.contourArea(cnt) > 1000 and cv2.contourArea(cnt) > (3.14*radius*radius*0.5):
-                print("Cell Detected")
-                cv2.drawContours(norm_image, cnt, -1, (100,140,204), 3)
-                M = cv2.moments(cnt)
-                cx = int(M['m10']/M['m00'])
-                cy = int(M['m01']/M['m00'])
-                # centroids.append([cx, cy])
+    # old cell size limits: contour area between 1000 and 8000 px
+    table = sweep(raw_image, [int(f*row) for f in diameterFracs], sigmaColors, sigmaSpaces, quantiles,
+                  min_area_frac=1000/(row*col), max_area_frac=8000/(row*col))
+    print_table(table)
+    print('total filter time [s]:', np.sum(table['filter_s'][table['quantile'] == quantiles[0]]))
 
-        plt.subplot(3,3,count+1)
-        plt.imshow(norm_image,interpolation='nearest')
-        title_string = 'C=' + str(sigmaColors[i]) + ' S=' + str(sigmaSpaces[j])
-        plt.title(title_string)
-        plt.xticks([])
-        plt.yticks([])
-        count = count + 1
-plt.show()
\ No newline at end of file
+    # cell count for every sigmaColor x sigmaSpace, one panel per diameter and quantile
+    plt.figure(figsize=(8,8))
+    count = 0
+    for d in np.unique(table['diameter']):
+        for q in quantiles:
+            sel = table[(table['diameter'] == d) & (table['quantile'] == q)]
+            grid = sel['cells'].reshape(len(sigmaColors),len(sigmaSpaces))
+            plt.subplot(len(diameterFracs),len(quantiles),count+1)
+            plt.imshow(grid,interpolation='nearest')
+            for i in range(len(sigmaColors)):
+                for j in range(len(sigmaSpaces)):
+                    plt.text(j,i,str(grid[i,j]),ha='center',va='center',color='w')
+            plt.title('d=' + str(d) + ' q=' + str(q))
+            plt.xticks(range(len(sigmaSpaces)),sigmaSpaces)
+            plt.yticks(range(len(sigmaColors)),sigmaColors)
+            plt.xlabel('sigmaSpace')
+            plt.ylabel('sigmaColor')
+            count = count + 1
+    plt.tight_layout()
+    plt.show()
@@ -0,0 +1,85 @@
+"""
+    Frame source for the OPTIX + EPHYS viewport.
+
+    Decodes images into resized grayscale frames and keeps the most recently
+    used ones in memory, so refreshing the viewport or re-running cell detection
+    on the frame already shown does not go back to disk. The next frame in the
+    list is decoded in the background while the current one is on screen.
+"""
+import threading
+from collections import OrderedDict
+from os.path import join
+import numpy as np
+from PIL import Image
+
+
+class FrameSource(object):
+    def __init__(self, root, names, size, max_frames=8, prefetch=True):
+        self.root = root
+        self.names = list(names)
+        self.size = tuple(size) # (width, height) of the displayed frame
+        self.max_frames = max_frames
+        self.prefetch = prefetch
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict() # (path, size) -> frame, oldest first
+        self._loading = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def _key(self, index):
+        return (join(self.root, self.names[index % len(self.names)]), self.size)
+
+    def _decode(self, key):
+        path, size = key
+        frame = np.array(Image.open(path).convert('L').resize(size))
+        frame.setflags(write=False) # shared between callers, copy before drawing on it
+        return frame
+
+    def _store(self, key, frame):
+        with self._lock:
+            self._frames[key] = frame
+            self._frames.move_to_end(key)
+            while len(self._frames) > self.max_frames:
+                self._frames.popitem(last=False)
+            self._loading.discard(key)
+
+    def _prefetch(self, index):
+        key = self._key(index)
+        with self._lock:
+            if key in self._frames or key in self._loading:
+                return
+            self._loading.add(key)
+        def load():
+            try:
+                self._store(key, self._decode(key))
+            except Exception:
+                with self._lock:
+                    self._loading.discard(key)
+        threading.Thread(target=load, daemon=True).start()
+
+    def get(self, index):
+        # PURPOSE: return the decoded frame at index (read only), from memory when possible
+        key = self._key(index)
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is not None:
+                self._frames.move_to_end(key)
+                self.hits += 1
+        if frame is None:
+            self.misses += 1
+            frame = self._decode(key)
+            self._store(key, frame)
+        if self.prefetch and len(self.names) > 1:
+            self._prefetch(index + 1)
+        return frame
+
+    def resize(self, size):
+        # PURPOSE: change the display size. Frames cached at the old size age out of the cache.
+        self.size = tuple(size)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
@@ -11,6 +11,10 @@ import cv2
 import pymmcore
 from timeit import default_timer as timer
 from datetime import datetime
+from acquisition import RingBuffer, AcquisitionThread
+from contrast import ContrastStretch
+from registration import MotionCorrector
+from tracking import CellTracker, draw_ids
 
 now = datetime.now() # datetime object containing current date and time
 print("now =", now)
@@ -21,35 +25,6 @@ N = 1024
 
 save_path = 'C:/Users/myip7/Documents/AND_Data/'
 
-def detect_img(yolo,img):
-    # image = Image.open(img) # Only used when opening an image from a folder/ not needed for the camera
-    r_image = yolo.detect_image(img)
-    # r_image.show()
-    return r_image
-
-def contrastStretch(image, min, max):
-    iI = image  # image input
-    minI = min  # minimum intensity (input)
-    maxI = max  # maxmimum intensity (input)
-    minO = 0  # minimum intensity (output)
-    maxO = 255  # maxmimum intensity (output)
-    iO = (iI - minI) * (((maxO - minO) / (maxI - minI)) + minO)  # image output    # for m in range(0,M):
-    # M = 1280
-    # N = 1024
-    # for m in range(0,M):
-    #     for n in range(0,N):
-    #         if minI < iI[m,n] < maxI:
-    #             iI[m,n] = iI[m,n]
-    #         elif iI[m,n] < minI:
-    #             iI[m,n] = 0
-    #         elif iI[m,n] > maxI:
-    #             iI[m,n] = 255
-    # if iI < minI:
-    #     iO = 0
-    # if iI > maxI:
-    #     iO = 255
-    return iO
-
 mmc = pymmcore.CMMCore()
 print('-----setup cam-----')
 mm_dir = 'C:/Program Files/Micro-Manager-2.0gamma/'
@@ -58,6 +33,9 @@ print(mmc.getVersionInfo())
 print(mmc.getAPIVersionInfo())
 
 use_YOLO = True
+tile_YOLO = False # detect on overlapping full-resolution tiles instead of one 416x416 letterbox; off until checked with the model on the rig
+tile_grid = None # None: 416x416 tiles (12 for 1280x1024); (rows, cols) for fewer, larger tiles and lower latency
+use_registration = False # align every frame to the first one (slice drift); the reference is not updated, so only for a fixed stage and focus
 my_yolo = YOLO() # start yolo session
 
 print('-----load cam-----')
@@ -71,8 +49,8 @@ im1 = mmc.getImage()
 min_range = 55 #30
 max_range = 80
 plt.figure(1)
-conStretch_vec = np.vectorize(contrastStretch)
-img = conStretch_vec(im1, min_range, max_range)
+contrastStretch = ContrastStretch(min_range, max_range) # lookup table, rebuilt only if the range changes
+img = contrastStretch(im1)
 plt.subplot(2,1,1)
 plt.imshow(im1,'gray')
 plt.subplot(2,1,2)
@@ -85,22 +63,35 @@ logFileTime = open(timeLog, mode='a')
 logFileTime.write("%s" % dt_string)
 
 cv2.namedWindow('live',cv2.WINDOW_AUTOSIZE)
+# Camera frames are drained into a ring buffer on a background thread; this loop always works on the newest one.
+ring = RingBuffer(8, im1.shape, im1.dtype, policy='drop-oldest')
+grabber = AcquisitionThread(mmc, ring)
+buffer = np.empty(im1.shape, im1.dtype) # reused every iteration
+alter = np.empty(im1.shape, 'uint8')
+aligned = np.empty(im1.shape, im1.dtype)
+corrector = MotionCorrector(bin=2) # 2x2 binned phase correlation keeps up with the camera
+tracker = CellTracker() # stable IDs for the YOLO detections
 mmc.startContinuousSequenceAcquisition(1)
+grabber.start()
 while True:
-    if mmc.getRemainingImageCount() > 0:
+    latest = ring.pop_latest(buffer, timeout=.01)
+    if latest is not None:
         start = timer()
-        # frame = mmc.getLastImage()
+        seq, stamp, frame = latest
+        if use_registration:
+            frame = corrector.update(frame, out=aligned)
         # print(frame)
         # print(frame.shape)
-        frame = mmc.popNextImage()
         # Specify the min and max range
-        # frame = conStretch_vec(frame, min_range, max_range)
         # Run detection
         if use_YOLO:
-            alter = contrastStretch(frame, min_range, max_range)
-            image = Image.fromarray(np.uint8(alter))
+            contrastStretch(frame, out=alter)
+            image = Image.fromarray(alter)
             # image = Image.fromarray(np.uint8(cm.gist_earth(frame)))
-            output = detect_img(my_yolo,image)
+            boxes, scores, classes = my_yolo.detect_tiled(image, grid=tile_grid) if tile_YOLO else my_yolo.detect(image)
+            centers = np.column_stack(((boxes[:,1] + boxes[:,3])/2, (boxes[:,0] + boxes[:,2])/2))
+            ids = tracker.update(centers)
+            output = draw_ids(my_yolo.renderer.draw(np.asarray(image), boxes, scores, classes), centers, ids, (255,0,0))
             # output = predict_with_yolo_head(model, frame, config, confidence=0.3, iou_threshold=0.4)
             output = np.array(output)
             cv2.imshow('live',output)
@@ -115,8 +106,14 @@ while True:
     if cv2.waitKey(1) & 0xFF == ord('q'): # This break key is critical, otherwise the live image does not load
         break
 # Close opencv window, MMC session, YOLOv3 session, and inference time log
+grabber.stop()
 cv2.destroyAllWindows()
 mmc.stopSequenceAcquisition()
+print('frames acquired: {written}, dropped (ring full): {dropped}, skipped (display behind): {skipped}'.format(**ring.stats()))
+print('camera buffer overflows:', grabber.overflows)
+if use_registration:
+    np.save(save_path + date + '_shifts.npy', corrector.shifts()) # per-frame drift [px]
+np.save(save_path + date + '_tracks.npy', tracker.history()) # frame, id, x, y of every detection
 mmc.reset()
 my_yolo.close_session() # end yolo session
 logFileTime.close()
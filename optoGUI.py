@@ -28,9 +28,19 @@ from PIL import ImageTk, Image
 import random #randomize locations for now
 import re # regex 
 import time # for sleeps
-import cv2
+import queue # hand results from worker threads to the Tk loop
 from serial.tools import list_ports
-from sutter import Sutter_driver
+from sutter import Sutter_driver, Async_Sutter, MoveInterrupted
+from sutter_sim import SutterSimulator
+from framesource import FrameSource
+from detection import IncrementalDetector, draw_cells
+from smoothing import BACKENDS as SMOOTHING_BACKENDS
+from protocol import compile_protocol, required_location, travel, ProtocolRunner, DONE, ABORTED
+from decimate import MinMaxPyramid, DecimatedLine
+from recording import open_recording
+from ephysfilter import FilterChain
+from traces import roi_labels, TraceExtractor, DeltaF
+from tracking import CellTracker, draw_ids
 
 # GUI Formatting params
 # Colors
@@ -40,6 +50,7 @@ washbath_num = 2
 cleanbath_num = 3
 abovewash_num = 4
 aboveclean_num = 5
+location_names = ['sample','abovebath','washbath','cleanbath','abovewash','aboveclean'] # indexed by the numbers above
 NOCOLOR = False
 if NOCOLOR:
     # autocleaning colors
@@ -109,6 +120,11 @@ wid = 550
 hei = 550
 
 CF = 0.0625 # conversion factor microsteps-->microns
+SIMULATE_SUTTER = False # True: talk to a simulated MPC-325 (sutter_sim.py) instead of the COM port
+SUTTER_POLL_MS = 50 # how often the GUI picks up manipulator results [ms]
+TRAJECTORY_RATE = None # pipette position samples per second logged while cleaning [Hz]; None = off until position polling during moves is checked on the rig
+EPHYS_WINDOW = 2. # seconds of live voltage shown in the PLOTS panel
+EPHYS_FILTER = dict(lowpass=5000., notch=60., highpass=None) # [Hz]; a high-pass (e.g. 1.) also removes the resting potential
 
 # Define GUI class
 class ephysTool(tk.Frame):
@@ -359,9 +375,13 @@ class ephysTool(tk.Frame):
         self.COMS_list = list(list_ports.comports())
         self.manip_COM_combo = ttk.Combobox(self.COM_box,values=self.COMS_list)
         self.COM_label = tk.Label(self.COM_box, text="Manipulator COM: ",font=(label_str),bg=settings_colors[framec])
-        if len(self.COMS_list) == 1:
+        if SIMULATE_SUTTER:
+            self.sutter_sim = SutterSimulator().start()
+            self.manip_COM_combo.set(self.sutter_sim.url)
+            self.sutter = Sutter_driver(port=self.sutter_sim.url,baudrate=128000,bytesize=8,stopbits=1)
+        elif len(self.COMS_list) == 1:
             self.manip_COM_combo.current(0)
-            self.sutter = Sutter_driver(port='COM3',baudrate=128000,bytesize=8,stopbits=1)
+            self.sutter = Sutter_driver(port=self.COMS_list[0].device,baudrate=128000,bytesize=8,stopbits=1)
 
         # Multiclamp handle
         self.multiclamp_box = tk.Frame(self.SETTINGS_FRAME,bg=settings_colors[framec],relief=styles[sty],borderwidth=size)
@@ -391,8 +411,13 @@ class ephysTool(tk.Frame):
 
         self.my_images = list(["1.png","2.png","3.png","3.png"])
         self.my_image_number = 0
+        self.frames = FrameSource(join(ROOT_PATH,'images'),self.my_images,(wid,hei)) # decoded + resized frames, cached
+        self.detector = None # IncrementalDetector, kept from one Find Cells to the next
+        self.tracker = CellTracker() # cell IDs across Find Cells presses
+        self.trace_extractor = None # ROIs of the last detected cells, see cellTraces
+        self.cell_dff = None
 
-        self.raw_tif = np.array(Image.open(join(ROOT_PATH,'images',self.my_images[self.my_image_number])).convert('L').resize((wid,hei)))
+        self.raw_tif = self.frames.get(self.my_image_number)
         self.display_tif = ImageTk.PhotoImage(image=Image.fromarray(self.raw_tif))
         self.viewport = self.camera_canvas.create_image(wid/2,hei/2,image=self.display_tif)
         
@@ -407,6 +432,7 @@ class ephysTool(tk.Frame):
 
         # plot frame widgets
         self.plots_label = tk.Label(self.PLOT_FRAME, text="PLOTS",font=(title_str),bg=plot_colors[framec])
+        self.load_recording_btn = tk.Button(self.PLOT_FRAME,text='LOAD RECORDING',font=(btn_str),bg=plot_colors[btnc],command=self.loadRecording)
         
         # plot 
         self.fig = Figure(figsize=(5, 4), dpi=100)
@@ -447,6 +473,14 @@ class ephysTool(tk.Frame):
         self.sspace_var = tk.DoubleVar()
         self.sspace_var.set(.019)
         self.sigma_space = tk.Spinbox(self.sspace_box,from_=0,to=10,increment=.005,textvariable=self.sspace_var,bg=connect_colors[btnc],command=self.idFluorescentCells)
+
+        # Filter backend: exact bilateral, or the faster downsampled/guided approximations (smoothing.py)
+        self.smoothing_str = tk.StringVar()
+        self.smoothing_str.set('bilateral')
+        self.smoothing_box = tk.Frame(self.CONNECT_FRAME,bg=connect_colors[framec],relief=styles[sty],borderwidth=size)
+        self.smoothing_combo = ttk.Combobox(self.smoothing_box,textvariable=self.smoothing_str,values=list(SMOOTHING_BACKENDS),state='readonly')
+        self.smoothing_label = tk.Label(self.smoothing_box, text="Filter: ",font=(label_str),bg=connect_colors[framec])
+        self.smoothing_combo.bind('<<ComboboxSelected>>',self.idFluorescentCells)
         
         # DEFINE HELP FRAME
         self.HELP_TAB = tk.Frame(self.tabs,bg='snow3',relief=styles[sty],borderwidth=size)
@@ -606,6 +640,7 @@ class ephysTool(tk.Frame):
         
         # plot frame packing
         self.plots_label.pack(side=tk.TOP,fill=tk.X,expand=1,padx=xpad,pady=ypad)
+        self.load_recording_btn.pack(side=tk.TOP,fill=tk.X,expand=0,padx=xpad,pady=ypad)
         
         # Pack plot because it's not in a frame
         self.canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=1)
@@ -630,6 +665,10 @@ class ephysTool(tk.Frame):
         self.sspace_label.pack(side=tk.LEFT,anchor=tk.E,expand=0,padx=xpad,pady=ypad)
         self.sigma_space.pack(side=tk.LEFT,anchor=tk.E,expand=0,padx=xpad,pady=ypad)
 
+        self.smoothing_box.pack(side=tk.TOP,anchor=tk.W,expand=0,padx=xpad,pady=ypad)
+        self.smoothing_label.pack(side=tk.LEFT,anchor=tk.E,expand=0,padx=xpad,pady=ypad)
+        self.smoothing_combo.pack(side=tk.LEFT,anchor=tk.E,expand=0,padx=xpad,pady=ypad)
+
         self.find_fluor_cells.pack(side=tk.LEFT,anchor=tk.E,expand=0,padx=xpad,pady=ypad)
         self.next.pack(side=tk.LEFT,anchor=tk.E,expand=0,padx=xpad,pady=ypad)
 
@@ -651,9 +690,16 @@ class ephysTool(tk.Frame):
         self.ax.set_xlabel('Time [s]')
         box = self.ax.get_position()
         self.ax.set_position([box.x0, box.y0, box.width*.75, box.height])
+        self.trace_lines = [] # DecimatedLine per plotted channel
+        self.live_line = None # live voltage (startLiveEphys)
 
         # Configure COM port communication with sutter
-        
+        self.sutter_async = Async_Sutter(self.sutter) if hasattr(self,'sutter') else None # commands run off the Tk thread
+        self.sutter_updates = queue.Queue() # results from the sutter worker, applied by pollSutter
+        self.pollSutter()
+        self.runner = None # ProtocolRunner while cleaning
+        self.protocol_updates = queue.Queue() # steps started by the runner, shown by pollProtocol
+        self.commanded_pressure = 0 # [mBar]
 
 # __________________________________________________________________________________________________________________________
 # __________________________________________________________________________________________________________________________
@@ -681,7 +727,7 @@ class ephysTool(tk.Frame):
         if self.my_image_number == len(self.my_images):
             self.my_image_number = 0
 
-        self.raw_tif = np.array(Image.open(join(ROOT_PATH,'images',self.my_images[self.my_image_number])).convert('L').resize((wid,hei)))
+        self.raw_tif = self.frames.get(self.my_image_number)
         self.img = ImageTk.PhotoImage(image=Image.fromarray(self.raw_tif))
         self.camera_canvas.itemconfig(self.viewport,image=self.img)
 
@@ -690,52 +736,144 @@ class ephysTool(tk.Frame):
     def idFluorescentCells(self,*args): 
         # PURPOSE: If button is pressed, identify fluorescent cells in the image. Once camera is set up, make sure to change image to camera's image. 
         color_num = 200
-        self.raw_tif = np.array(Image.open(join(ROOT_PATH,'images',self.my_images[self.my_image_number])).convert('L').resize((wid,hei)))
+        self.raw_tif = self.frames.get(self.my_image_number)
         
         row,col = self.raw_tif.shape
         raw_image = self.raw_tif
         
         # Read image (from camera)
-        norm_image = raw_image/np.max(raw_image)
-        contour_image = raw_image
-
-        # filter to preserve edges, threshold above 97 percentile 'fluorescence', use 2.4% of size for filter size
-        bilateral_filtered_image = cv2.bilateralFilter(norm_image.astype('float32'), int(float(self.scolor_var.get())*row), int(float(self.sspace_var.get())*row), int(.019*row))
-        ret, masked_image = cv2.threshold(bilateral_filtered_image,np.quantile(norm_image,float(self.threshold_perc.get())/100),1,cv2.THRESH_BINARY)
-        
-        # find contours from masked image  
-        contours, hierarchy = cv2.findContours(masked_image.astype('uint8'),cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_NONE)
-
-        # detect if cell or not 
-        centroids = list()
-        for cnt in contours:
-            # measure minimum enclosing circle for each contour detected
-            (x,y),radius = cv2.minEnclosingCircle(cnt)
-
-            # if contour size is between .05% and 1% of field of view, count as cell
-            # also check if min enclosing circle is significantly bigger than contourArea to measure roundness
-            if cv2.contourArea(cnt) < .01*row*col and cv2.contourArea(cnt) > .0005*row*col and cv2.contourArea(cnt) > (radius*radius*3.1415*.5):
-                cv2.drawContours(contour_image, cnt, -1, (color_num,color_num,color_num), linewidth)
-
-                M = cv2.moments(cnt)
-                cx = int(M['m10']/M['m00'])
-                cy = int(M['m01']/M['m00'])
-                
-                centroids.append([cx, cy])
-                cv2.drawMarker(contour_image,(cx,cy),(color_num, color_num, color_num), cv2.MARKER_CROSS,10,1)
+        contour_image = raw_image.copy() # cached frame is read only, draw on a copy
+
+        # filter to preserve edges, threshold above 97 percentile 'fluorescence', use 2.4% of size for filter size,
+        # then measure every blob at once and keep the ones that look like cells
+        # (size between .05% and 1% of field of view, at least half of the enclosing circle, see detection.py).
+        # Frames after the first are only redone where they changed; new settings start over with a full pass.
+        settings = (float(self.threshold_perc.get()),float(self.scolor_var.get()),float(self.sspace_var.get()),self.smoothing_str.get())
+        if self.detector is None or self.detector.settings != settings:
+            self.detector = IncrementalDetector(*settings)
+        self.cells, labels = self.detector.detect(raw_image)
+        centroids = np.rint(np.column_stack((self.cells['cx'],self.cells['cy']))).astype(int)
+        draw_cells(contour_image,self.cells,labels,color_num,linewidth)
+        self.cell_ids = self.tracker.update(np.column_stack((self.cells['cx'],self.cells['cy']))) # same cell, same ID from frame to frame
+        draw_ids(contour_image,centroids,self.cell_ids,color_num)
+
+        # ROIs for fluorescence traces of the detected cells in the following frames (cellTraces)
+        if len(self.cells):
+            self.trace_extractor = TraceExtractor(roi_labels(labels,self.cells))
+            self.cell_dff = DeltaF(len(self.cells))
+        else: # no cells: don't keep tracing the ROIs of an earlier detection
+            self.trace_extractor = None
+            self.cell_dff = None
 
         self.img = ImageTk.PhotoImage(image=Image.fromarray(contour_image))
 
         # self.camera_canvas.delete(self.viewport)
         self.camera_canvas.itemconfig(self.viewport,image=self.img)
 
+    def cellTraces(self,frame):
+        # PURPOSE: mean intensity and dF/F of every detected cell in a new frame (same size as the detection image).
+        # None when the last detection found no cells.
+        if self.trace_extractor is None:
+            return None
+        f = self.trace_extractor.means(frame)
+        return f, self.cell_dff.update(f)
+
+    def clearTraces(self):
+        # PURPOSE: take recordings and the live trace off the PLOTS axes
+        for line in self.trace_lines:
+            line.remove()
+        self.trace_lines = []
+        if self.live_line is not None:
+            self.live_line.remove()
+            self.live_line = None
+
+    def plotTraces(self,traces,rate,labels=None,ylabel='Voltage [mV]'):
+        # PURPOSE: plot recordings (one 1D array per channel, sampled at rate [Hz]) in the PLOTS panel. Each channel
+        # gets a min/max pyramid once; pan/zoom then redraws ~2 points per pixel instead of every sample.
+        self.clearTraces()
+        labels = labels or [None]*len(traces)
+        self.trace_lines = [DecimatedLine(self.ax, MinMaxPyramid(trace), rate, label=label) for trace, label in zip(traces, labels)]
+        extents = np.array([line.pyramid.extent() for line in self.trace_lines], dtype='float64')
+        lo, hi = extents[:,0].min(), extents[:,1].max()
+        pad = .05*(hi - lo) if hi > lo else 1.
+        self.ax.set_xlim(0, max(len(trace) for trace in traces)/rate) # queries every line at the new range
+        self.ax.set_ylim(lo - pad, hi + pad)
+        self.ax.set_ylabel(ylabel)
+        if labels[0] is not None:
+            self.ax.legend(loc='upper left', bbox_to_anchor=(1, 1))
+        self.canvas.draw_idle()
+
+    def startLiveEphys(self,rate):
+        # PURPOSE: set up the PLOTS panel for live voltage. Chunks handed to showLiveEphys are filtered with carried
+        # state and written over the oldest samples of a fixed EPHYS_WINDOW (oscilloscope style), nothing reallocated.
+        self.clearTraces()
+        self.live_filter = FilterChain(rate, **EPHYS_FILTER)
+        self.live_y = np.full(int(EPHYS_WINDOW*rate), np.nan)
+        self.live_pos = 0
+        self.live_line, = self.ax.plot(np.arange(len(self.live_y))/rate, self.live_y)
+        self.ax.set_xlim(0, EPHYS_WINDOW)
+        self.canvas.draw_idle()
+
+    def showLiveEphys(self,chunk):
+        # PURPOSE: filter the next chunk of the voltage channel [mV] and draw it (call on the Tk thread)
+        filtered = self.live_filter.process(np.asarray(chunk, dtype='float64'))[-len(self.live_y):]
+        n, size = len(filtered), len(self.live_y)
+        first = min(n, size - self.live_pos)
+        self.live_y[self.live_pos:self.live_pos+first] = filtered[:first]
+        self.live_y[:n-first] = filtered[first:] # wrap around to the start of the window
+        self.live_pos = (self.live_pos + n) % size
+        self.live_y[self.live_pos:self.live_pos+int(.01*size)] = np.nan # gap in front of the newest sample
+        self.live_line.set_ydata(self.live_y)
+        if self.ax.get_autoscaley_on():
+            self.ax.relim()
+            self.ax.autoscale_view(scalex=False)
+        self.canvas.draw_idle()
+
+    def loadRecording(self):
+        # PURPOSE: open an ABF/AxoGraph file (memory-mapped, nothing is read up front) and plot every channel
+        f = filedialog.askopenfilename(title='Select recording',filetypes=[('Recordings', '*.abf *.axgd *.axgx'),('All files', '*')])
+        if not f:
+            return
+        try:
+            self.recording = open_recording(f)
+        except (ValueError, NotImplementedError) as e:
+            showwarning("Warning","Could not open the recording: " + str(e))
+            return
+        rec = self.recording
+        traces = []
+        for c in range(rec.channel_count):
+            try:
+                traces.append(rec.channel(c)) # gap free: all sweeps back to back
+            except ValueError: # episodic AxoGraph file: show the first sweep
+                traces.append(rec.sweep(0,c))
+        labels = ['{} ({})'.format(name,units) for name,units in zip(rec.channel_names,rec.units)]
+        self.plotTraces(traces, rec.rate, labels=labels, ylabel='{} [{}]'.format(rec.channel_names[0],rec.units[0]))
+        self.status.set('Loaded ' + f)
+
+    def locationVars(self,loc):
+        # PURPOSE: the x, y, z tk variables that hold a location
+        name = location_names[loc]
+        return getattr(self,name+'_x_value'), getattr(self,name+'_y_value'), getattr(self,name+'_z_value')
+
+    def locationValues(self):
+        # PURPOSE: every location as {name: [x, y, z]} microns
+        return {name: [v.get() for v in self.locationVars(loc)] for loc, name in enumerate(location_names)}
+
     def goToLocation(self,loc):
-        #PURPOSE: move the manipulator to a location
+        #PURPOSE: move the manipulator to a location, up to the above bath height first, across, then down.
+        # Returns right away, the moves run on the sutter worker thread.
+        locations = self.locationValues()
+        try:
+            target = required_location(locations, location_names[loc])
+            safe_z = required_location(locations, 'abovebath')[2]
+        except ValueError as e:
+            showwarning("Warning","Cannot move: " + str(e))
+            return
+
         if loc == sample_num:
             self.status.set('Moving to sample')
-            # moveStr = 
         elif loc == abovebath_num:
-            self.status.set('Moving to sample')
+            self.status.set('Moving to above bath')
         elif loc == cleanbath_num:
             self.status.set('Moving to clean bath')
         elif loc == washbath_num:
@@ -744,39 +882,44 @@ class ephysTool(tk.Frame):
             self.status.set('Moving to above clean bath')
         elif loc == abovewash_num:
             self.status.set('Moving to above wash bath')
-            
-        self.sutter.Move2Pos(moveStr)
+
+        if self.sutter_async is None:
+            self.status.set('No manipulator connected.')
+            return
+        def go(pos): # on the sutter worker thread, once the current position is known
+            if pos.cancelled() or pos.exception() is not None:
+                self.sutter_updates.put(('moved',loc,pos))
+                return
+            path = self.sutter_async.MovePath(travel(pos.result(), target, safe_z))
+            path.add_done_callback(lambda f: self.sutter_updates.put(('moved',loc,f)))
+        self.sutter_async.CurrentPos().add_done_callback(go)
+
     def setLocation(self,loc):
-        # PURPOSE: get location from controller and convert to array of bytes
-        cmdStr = self.sutter.CurrentPos() # full command string sent to controller
-        cmdByteStr = bytearray(cmdStr) # split into bytes for easy indexing
-        driveNum = cmdByteStr[0]
-        xByte = cmdByteStr[1:4]
-        yByte = cmdByteStr[5:8]
-        zByte = cmdByteStr[9:12]
-
-        # convert to int: must be unsigned, little endian format... units are microsteps
-        x_umstep = int.from_bytes(xByte,byteorder='little',signed=False) 
-        y_umstep = int.from_bytes(yByte,byteorder='little',signed=False) 
-        z_umstep = int.from_bytes(zByte,byteorder='little',signed=False) 
-
-        x_micron = int(x_umstep*CF)
-        y_micron = int(y_umstep*CF)
-        z_micron = int(z_umstep*CF)
-
-        if loc == abovebath_num:
-            self.abovebath_x_value.set(x_micron)
-            self.abovebath_y_value.set(y_micron)
-            self.abovebath_z_value.set(z_micron)
-        elif loc == washbath_num:
-            self.washbath_x_value.set(x_micron)
-            self.washbath_y_value.set(y_micron)
-            self.washbath_z_value.set(z_micron)
-        elif loc == cleanbath_num:
-            self.cleanbath_x_value.set(x_micron)
-            self.cleanbath_y_value.set(y_micron)
-            self.cleanbath_z_value.set(z_micron)
-        
+        # PURPOSE: ask the controller for its position; pollSutter stores it in the location when it arrives (microns)
+        if self.sutter_async is None:
+            self.status.set('No manipulator connected.')
+            return
+        pos = self.sutter_async.CurrentPos()
+        pos.add_done_callback(lambda f: self.sutter_updates.put(('location',loc,f)))
+
+    def pollSutter(self):
+        # PURPOSE: runs on the Tk loop every SUTTER_POLL_MS, applies results handed over by the sutter worker thread
+        while True:
+            try:
+                kind, loc, f = self.sutter_updates.get_nowait()
+            except queue.Empty:
+                break
+            if f.cancelled() or isinstance(f.exception(), MoveInterrupted):
+                self.status.set('Move to ' + location_names[loc] + ' stopped.')
+            elif f.exception() is not None:
+                self.status.set('Manipulator error: ' + str(f.exception()))
+            elif kind == 'location':
+                for var, micron in zip(self.locationVars(loc), f.result()):
+                    var.set(int(micron))
+            else: # moved
+                self.status.set('Arrived at ' + location_names[loc] + '.')
+        self.master.after(SUTTER_POLL_MS, self.pollSutter)
+
     def saveLocations(self):
         #PURPOSE: save the locations in the window as a csv for loading later on
         above = np.array((self.abovebath_x_value.get(),self.abovebath_y_value.get(),self.abovebath_z_value.get()),dtype='int32')
@@ -898,25 +1041,77 @@ class ephysTool(tk.Frame):
             f.write(temppres)
             f.close()
 
+    def readProtocolDisplay(self,protocol_type):
+        # PURPOSE: time [s] and pressure [mBar] vectors as typed in the WASH/CLEAN boxes
+        if protocol_type == 'clean':
+            times, pres = self.clean_time_display.get(1.0,tk.END), self.clean_pres_display.get(1.0,tk.END)
+        else: # wash
+            times, pres = self.wash_time_display.get(1.0,tk.END), self.wash_pres_display.get(1.0,tk.END)
+        return [float(t) for t in times.split()], [float(p) for p in pres.split()]
+
     def cleanPipette(self):
-        # PURPOSE: do the cleaning protocol 
-        showinfo("Ready?",'Make sure that the pipette is at a safe location above the sample. Then press OK.')
+        # PURPOSE: do the cleaning protocol. The steps run on a ProtocolRunner thread; pollProtocol follows them.
+        if self.runner is not None and self.runner.is_alive():
+            self.status.set('Cleaning protocol already running.')
+            return
+        showinfo("Ready?",'Make sure that the pipette is at a safe location above the sample, it returns there at the end. Then press OK.')
 
         self.status.set('Initializing cleaning protocol...')
-        # # time.sleep(2)
-
-        # self.status.set('Moving laterally to baths...')
-        # # time.sleep(2)
+        locations = self.locationValues()
+        try:
+            clean_times, clean_pres = self.readProtocolDisplay('clean')
+            wash_times, wash_pres = self.readProtocolDisplay('wash')
+            steps = compile_protocol(locations, clean_times, clean_pres, wash_times, wash_pres,
+                                     prewash=self.prewash.get() == 1, sham=self.protocol.get() == 1)
+        except ValueError as e:
+            showwarning("Warning","Cannot run the protocol: " + str(e))
+            return
 
-        # self.status.set('Axial movement to bath ...')
-        # # time.sleep(2)
-        
-        # self.status.set('Dip in bath...')
-        # # time.sleep(2)
-        self.done_indicator.configure(background='green2')
+        # show the retract points the protocol uses over each bath
+        for step in steps:
+            if step.label in ('abovewash','aboveclean'):
+                for var, micron in zip(self.locationVars(location_names.index(step.label)), step.value):
+                    var.set(int(micron))
+
+        if self.sutter_async is None:
+            self.status.set('No manipulator connected: running pressure steps only.')
+        self.runner = ProtocolRunner(steps, self.sutter_async, self.setPressure,
+                                     on_step=lambda i, step: self.protocol_updates.put((i, step)),
+                                     trajectory_rate=TRAJECTORY_RATE)
+        self.done_indicator.configure(background='yellow', text='CLEANING')
+        self.runner.start()
+        self.pollProtocol()
+
+    def setPressure(self,mbar):
+        # PURPOSE: called from the protocol thread at each pressure step. Hook for the pressure controller.
+        self.commanded_pressure = mbar
+
+    def pollProtocol(self):
+        # PURPOSE: runs on the Tk loop while cleaning, shows each step as the runner starts it
+        while True:
+            try:
+                i, step = self.protocol_updates.get_nowait()
+            except queue.Empty:
+                break
+            if step.kind == 'move':
+                self.status.set('Step {}/{}: moving to {}'.format(i+1, len(self.runner.steps), step.label))
+            else:
+                self.status.set('Step {}/{}: {} {:g} mBar for {:g} s'.format(i+1, len(self.runner.steps), step.label, step.value, step.duration))
+        if self.runner.is_alive():
+            self.master.after(SUTTER_POLL_MS, self.pollProtocol)
+        elif self.runner.state == DONE:
+            self.status.set('Cleaning done. ' + self.runner.report())
+            self.done_indicator.configure(background='green2', text='DONE')
+        elif self.runner.state != ABORTED: # failed; an abort already set the indicator
+            self.status.set('Cleaning failed: ' + str(self.runner.error))
+            self.done_indicator.configure(background='red', text='FAILED')
 
     def stopCleaning(self):
         # PURPOSE: Stop everything (like estop)
+        if self.runner is not None and self.runner.is_alive():
+            self.runner.abort() # interrupts the manipulator, protocol thread stops within one tick
+        elif self.sutter_async is not None:
+            self.sutter_async.Interrupt() # stops the manipulator now, drops queued moves
         self.done_indicator.configure(background='red')
         self.done_indicator.configure(text='USER STOPPED')
 
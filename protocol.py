@@ -0,0 +1,247 @@
+"""
+    Pipette cleaning protocol: schedule and executor.
+
+    compile_protocol() turns the WASH/CLEAN time and pressure vectors and the
+    saved bath locations into a flat list of steps:
+
+        move above sample -> above clean bath -> into clean bath
+        clean pressure steps (each held for its time)
+        move above clean bath -> above wash bath -> into wash bath
+        wash pressure steps
+        move above wash bath -> above sample -> back to the start position
+
+    ProtocolRunner runs the steps on its own thread so the Tk loop never waits.
+    Moves go through Async_Sutter and end when the controller answers. Pressure
+    steps follow deadlines on time.perf_counter() counted from the start of
+    their block, so a late step does not push back the ones after it. abort()
+    interrupts the manipulator and returns within one control tick.
+
+    The last move has no fixed target (value None): the runner reads the
+    manipulator position when it starts and returns there, since the sample
+    location cannot be set from the GUI yet.
+"""
+import collections
+import threading
+import time
+from concurrent.futures import CancelledError, TimeoutError as FuturesTimeout
+import numpy as np
+from sutter import MoveInterrupted
+
+# kind: 'move' (value = x, y, z microns) or 'pressure' (value = mBar, held for duration seconds)
+Step = collections.namedtuple('Step', 'kind label value duration')
+
+TIMING_DTYPE = np.dtype([('step', 'i4'), ('scheduled', 'f8'), ('started', 'f8'), ('finished', 'f8')])
+
+RUNNING = 'running'
+DONE = 'done'
+ABORTED = 'aborted'
+FAILED = 'failed'
+
+
+def above(location, safe_z):
+    # PURPOSE: the retract point over a location: same x, y at the safe height
+    return (location[0], location[1], safe_z)
+
+
+def travel(start, target, safe_z):
+    # PURPOSE: points from start to target that keep the pipette at the safe height in between: straight up,
+    # across, then down
+    return [above(start, safe_z), above(target, safe_z), tuple(target)]
+
+
+def required_location(locations, name):
+    # PURPOSE: the (x, y, z) of a location the protocol moves to; unset (missing or all zero) is an error, since
+    # moving there would drive the pipette to the controller origin
+    location = locations.get(name)
+    if location is None or not any(location):
+        raise ValueError(name + ' location is not set')
+    return tuple(location)
+
+
+def pressure_steps(times, pressures, label, sham=False):
+    if len(times) != len(pressures):
+        raise ValueError('{} protocol: {} times but {} pressures'.format(label, len(times), len(pressures)))
+    if any(t < 0 for t in times):
+        raise ValueError(label + ' protocol: negative step time')
+    return [Step('pressure', label, 0 if sham else p, float(t)) for t, p in zip(times, pressures)]
+
+
+def compile_protocol(locations, clean_times, clean_pressures, wash_times, wash_pressures, prewash=False, sham=False):
+    # PURPOSE: list of Steps for one cleaning cycle. locations maps the names in optoGUI.location_names to
+    # (x, y, z) microns; abovebath, cleanbath and washbath must be set. The above-bath points are taken at the z
+    # of 'abovebath'. The cycle ends where the pipette was when it started. sham: same moves and timing,
+    # pressure held at 0 mBar.
+    abovebath = required_location(locations, 'abovebath')
+    cleanbath = required_location(locations, 'cleanbath')
+    washbath = required_location(locations, 'washbath')
+    safe_z = abovebath[2]
+    clean = [Step('move', 'aboveclean', above(cleanbath, safe_z), 0.),
+             Step('move', 'cleanbath', cleanbath, 0.)]
+    clean += pressure_steps(clean_times, clean_pressures, 'clean', sham)
+    clean += [Step('move', 'aboveclean', above(cleanbath, safe_z), 0.)]
+    wash = [Step('move', 'abovewash', above(washbath, safe_z), 0.),
+            Step('move', 'washbath', washbath, 0.)]
+    wash += pressure_steps(wash_times, wash_pressures, 'wash', sham)
+    wash += [Step('move', 'abovewash', above(washbath, safe_z), 0.)]
+
+    steps = [Step('move', 'abovebath', abovebath, 0.)]
+    steps += (wash if prewash else []) + clean + wash
+    steps += [Step('move', 'abovebath', abovebath, 0.),
+              Step('move', 'start', None, 0.)] # filled in by ProtocolRunner
+    return steps
+
+
+class ProtocolRunner(threading.Thread):
+    def __init__(self, steps, sutter, set_pressure, tick=.01, on_step=None, trajectory_rate=None):
+        # sutter: Async_Sutter (None runs the pressure steps only); set_pressure(mbar) is called on this thread.
+        # on_step(index, step) is called as each step starts; trajectory_rate [Hz] logs the pipette path
+        # with Async_Sutter.StartStream for the length of the protocol.
+        threading.Thread.__init__(self, daemon=True)
+        self.steps = list(steps)
+        self.sutter = sutter
+        self.set_pressure = set_pressure
+        self.tick = tick # longest time between checks for abort() [s]
+        self.on_step = on_step
+        self.trajectory_rate = trajectory_rate
+        self.trajectory = None # Position_Log when trajectory_rate is set
+        self.timing = np.zeros(len(self.steps), dtype=TIMING_DTYPE)
+        self.timing['step'] = np.arange(len(self.steps))
+        for field in ('scheduled', 'started', 'finished'):
+            self.timing[field] = np.nan
+        self.state = RUNNING
+        self.error = None
+        self._abort = threading.Event()
+
+    def abort(self):
+        # stops the protocol at the next tick; the move in progress is interrupted at once
+        self._abort.set()
+        if self.sutter is not None:
+            self.sutter.Interrupt()
+
+    def run(self):
+        if self.sutter is not None and self.trajectory_rate:
+            self.trajectory = self.sutter.StartStream(self.trajectory_rate)
+        try:
+            if self.sutter is not None and any(step.kind == 'move' and step.value is None for step in self.steps):
+                start = tuple(self.sutter.CurrentPos().result()) # where the moves without a target return to
+                self.steps = [step._replace(value=start) if step.kind == 'move' and step.value is None else step
+                              for step in self.steps]
+            self._run_steps()
+            self.state = ABORTED if self._abort.is_set() else DONE
+        except Exception as e:
+            self.error = e
+            self.state = FAILED
+        finally:
+            if self.state != DONE:
+                self.set_pressure(0) # release the pressure when stopped midway
+            if self.trajectory is not None:
+                self.sutter.StopStream()
+
+    def _run_steps(self):
+        block_start = None # deadline origin of the current run of pressure steps
+        for i, step in enumerate(self.steps):
+            if self._abort.is_set():
+                return
+            if step.kind == 'pressure':
+                if block_start is None:
+                    block_start = deadline = time.perf_counter()
+                if not self._wait_until(deadline):
+                    return
+                self.timing['scheduled'][i] = deadline
+                self.timing['started'][i] = time.perf_counter()
+                if self.on_step is not None:
+                    self.on_step(i, step)
+                self.set_pressure(step.value)
+                deadline += step.duration
+                if i + 1 == len(self.steps) or self.steps[i + 1].kind != 'pressure':
+                    if not self._wait_until(deadline): # hold the last pressure for its full time
+                        return
+                    block_start = None
+                self.timing['finished'][i] = time.perf_counter()
+            else:
+                self.timing['started'][i] = time.perf_counter()
+                if self.on_step is not None:
+                    self.on_step(i, step)
+                if self.sutter is not None and not self._wait_move(self.sutter.Move2Pos(*step.value)):
+                    return
+                self.timing['finished'][i] = time.perf_counter()
+
+    def _wait_until(self, deadline):
+        # False if aborted first. Event.wait returns as soon as abort() is called.
+        remaining = deadline - time.perf_counter()
+        while remaining > 0:
+            if self._abort.wait(remaining):
+                return False
+            remaining = deadline - time.perf_counter()
+        return not self._abort.is_set()
+
+    def _wait_move(self, move):
+        # False if aborted first; raises the controller's error, if any
+        while True:
+            try:
+                move.result(timeout=self.tick) # returns as soon as the move ends
+                return not self._abort.is_set()
+            except (CancelledError, MoveInterrupted): # dropped or stopped by Interrupt()
+                return False
+            except FuturesTimeout:
+                if move.done():
+                    raise # the controller's own timeout, not ours
+                if self._abort.is_set():
+                    move.cancel()
+                    return False
+
+    def jitter(self):
+        # start error of every pressure step that ran, in seconds (positive = late)
+        ran = ~np.isnan(self.timing['scheduled'])
+        return self.timing['started'][ran] - self.timing['scheduled'][ran]
+
+    def report(self):
+        jitter = 1e3*self.jitter()
+        if not len(jitter):
+            return 'no timed steps ran'
+        return '{} timed steps, start error {:.3f} ms mean, {:.3f} ms max'.format(len(jitter), jitter.mean(), jitter.max())
+
+
+if __name__ == '__main__':
+    # clean/wash timing against the default GUI protocol, with and without the simulated manipulator
+    from sutter import Sutter_driver, Async_Sutter
+    from sutter_sim import SutterSimulator
+
+    locations = {'abovebath': (1000, 1000, 400), 'washbath': (1300, 1000, 0), 'cleanbath': (700, 1000, 0)}
+    clean_times, clean_pressures = [.05]*12, [-345, -345, 700, -345, 700, -345, 700, -345, 700, -345, 700, 700]
+    wash_times, wash_pressures = [.05, .1], [-345, 700]
+    steps = compile_protocol(locations, clean_times, clean_pressures, wash_times, wash_pressures)
+    pressures = []
+    runner = ProtocolRunner(steps, None, lambda p: pressures.append((time.perf_counter(), p)))
+    runner.start()
+    runner.join()
+    print('pressure only:', runner.state, runner.report())
+
+    # old style: sleep between steps, errors add up
+    start = time.perf_counter()
+    late = []
+    t = start
+    for d in clean_times:
+        late.append(time.perf_counter() - t)
+        time.sleep(d)
+        t += d
+    late = 1e3*np.array(late)
+    print('sleep loop:    {} steps, start error {:.3f} ms mean, {:.3f} ms max'.format(len(late), late.mean(), late.max()))
+
+    with SutterSimulator(speed=10000, latency=.001) as sim:
+        sutter = Async_Sutter(Sutter_driver(port=sim.url, baudrate=128000, bytesize=8, stopbits=1, Ans=1))
+        runner = ProtocolRunner(steps, sutter, lambda p: None, trajectory_rate=200)
+        start = time.perf_counter()
+        runner.start()
+        runner.join()
+        print('with manipulator:', runner.state, runner.error or '', runner.report(), '{:.2f} s total'.format(time.perf_counter() - start))
+        print('trajectory: {} positions at {:.0f} Hz'.format(runner.trajectory.count, runner.trajectory.rate()))
+
+        runner = ProtocolRunner(steps, sutter, lambda p: None)
+        runner.start()
+        time.sleep(.1)
+        start = time.perf_counter()
+        runner.abort()
+        runner.join()
+        print('abort: {} after {:.2f} ms'.format(runner.state, 1e3*(time.perf_counter() - start)))
+        sutter.Close()
@@ -0,0 +1,213 @@
+"""
+    Memory-mapped ABF and AxoGraph recordings.
+
+    open_recording(path) reads only the file header and memory-maps the data
+    section, so opening takes the same time for a 10 MB or a 10 GB file and
+    nothing is loaded until it is sliced:
+
+        rec = open_recording('cell1.abf')
+        v = rec.channel(0)          # Trace, gap free: every sample of channel 0
+        v[:20000]                   # first second at 20 kHz, float32 in rec.units[0]
+        rec.sweep(3, 1)             # sweep 3 of channel 1 (episodic files)
+
+    A Trace slices like a 1D array; the raw integers are scaled to mV/pA on
+    access (gain and offset from the header). np.asarray(trace) loads it all.
+
+    ABF 1/2: the header is parsed by pyabf.ABF(path, loadData=False).
+    AxoGraph (.axgd/.axgx, format 1-6): column headers are walked with seeks,
+    the data are big-endian.
+"""
+import os
+import struct
+import numpy as np
+import pyabf
+
+
+class Trace(object):
+    def __init__(self, raw, gain=1., offset=0.):
+        self.raw = raw # memmap view, file dtype
+        self.gain = gain
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.raw)
+
+    @property
+    def shape(self):
+        return (len(self.raw),)
+
+    @property
+    def dtype(self):
+        return np.dtype('float32')
+
+    def __getitem__(self, key):
+        values = np.asarray(self.raw[key], dtype='float32')
+        if self.gain != 1:
+            values *= self.gain
+        if self.offset != 0:
+            values += self.offset
+        return values
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[:]
+        return values if dtype is None else values.astype(dtype)
+
+
+class Recording(object):
+    # common interface: path, rate [Hz], channel_names, units, sweep_count, sweep_points (per sweep and channel)
+    def channel(self, channel):
+        raise NotImplementedError
+
+    def sweep(self, sweep, channel=0):
+        raise NotImplementedError
+
+    @property
+    def channel_count(self):
+        return len(self.channel_names)
+
+    @property
+    def duration(self):
+        # seconds of data per channel
+        return self.sweep_count*self.sweep_points/self.rate
+
+
+class AbfRecording(Recording):
+    def __init__(self, path):
+        abf = pyabf.ABF(path, loadData=False) # header only
+        self.path = path
+        self.header = abf
+        self.rate = float(abf.dataRate)
+        self.channel_names = list(abf.adcNames)
+        self.units = list(abf.adcUnits)
+        self.sweep_count = abf.sweepCount
+        self.sweep_points = abf.sweepPointCount
+        channels = abf.channelCount
+        if abf._nDataFormat == 0:
+            dtype = np.int16
+            self._scale = [(abf._dataGain[c], abf._dataOffset[c]) for c in range(channels)]
+        else: # float32 samples are stored already scaled
+            dtype = np.float32
+            self._scale = [(1., 0.)]*channels
+        # samples are interleaved: one row per time point, one column per channel
+        self._data = np.memmap(path, dtype=dtype, mode='r', offset=abf.dataByteStart,
+                               shape=(abf.dataPointCount//channels, channels))
+
+    def channel(self, channel):
+        gain, offset = self._scale[channel]
+        return Trace(self._data[:, channel], gain, offset)
+
+    def sweep(self, sweep, channel=0):
+        if not 0 <= sweep < self.sweep_count:
+            raise IndexError('sweep {} out of range ({} sweeps)'.format(sweep, self.sweep_count))
+        gain, offset = self._scale[channel]
+        rows = slice(sweep*self.sweep_points, (sweep + 1)*self.sweep_points)
+        return Trace(self._data[rows, channel], gain, offset)
+
+
+AXOGRAPH_TYPES = {4: ('>i2', 0), 5: ('>i4', 0), 6: ('>f4', 0), 7: ('>f8', 0), 10: ('>i2', 16)} # column type: dtype, scale bytes
+
+
+class AxographRecording(Recording):
+    def __init__(self, path):
+        self.path = path
+        columns = [] # (title, memmap or None, gain, offset)
+        first = increment = None
+        with open(path, 'rb') as f:
+            header_id = f.read(4)
+            if header_id == b'AxGr':
+                version, n_columns = struct.unpack('>hh', f.read(4))
+            elif header_id in (b'axgx', b'axgd'):
+                version, n_columns = struct.unpack('>ll', f.read(8))
+            else:
+                raise ValueError(path + ' is not an AxoGraph file')
+            for i in range(n_columns):
+                n_points, = struct.unpack('>l', f.read(4))
+                if version < 3:
+                    title = f.read(80)
+                    title = title[1:1 + title[0]].decode('utf-8', 'replace') # Pascal string
+                    if version == 2 and i == 0: # time: first value and interval only
+                        first, increment = struct.unpack('>ff', f.read(8))
+                        continue
+                    if version == 2:
+                        dtype, (gain,), offset = '>i2', struct.unpack('>f', f.read(4)), 0.
+                    else:
+                        dtype, gain, offset = '>f4', 1., 0.
+                else:
+                    column_type, length = struct.unpack('>ll', f.read(8))
+                    title = f.read(max(length, 0)).decode('utf-16-be')
+                    if column_type == 9: # series (time): first value and interval only
+                        first, increment = struct.unpack('>dd', f.read(16))
+                        continue
+                    if column_type not in AXOGRAPH_TYPES:
+                        raise NotImplementedError('AxoGraph column type {} in {}'.format(column_type, path))
+                    dtype, scale_bytes = AXOGRAPH_TYPES[column_type]
+                    gain, offset = struct.unpack('>dd', f.read(16)) if scale_bytes else (1., 0.)
+                data = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=(n_points,))
+                f.seek(data.nbytes, os.SEEK_CUR)
+                columns.append((title, data, gain, offset))
+        if increment is None: # time stored as an ordinary first column
+            title, data, gain, offset = columns.pop(0)
+            first, increment = data[0]*gain + offset, (data[1] - data[0])*gain
+        self.rate = 1./float(increment)
+        self.t0 = float(first)
+        # every column after time is one sweep of one channel; channels are told apart by title
+        self.channel_names, self.units, self._sweeps = [], [], []
+        for title, data, gain, offset in columns:
+            name, units = title, ''
+            if title.endswith(')') and '(' in title:
+                name, units = title[:title.rindex('(')].strip(), title[title.rindex('(') + 1:-1]
+            if name not in self.channel_names:
+                self.channel_names.append(name)
+                self.units.append(units)
+                self._sweeps.append([])
+            self._sweeps[self.channel_names.index(name)].append(Trace(data, gain, offset))
+        self.sweep_count = max(len(s) for s in self._sweeps) if self._sweeps else 0
+        self.sweep_points = len(columns[0][1]) if columns else 0
+
+    def sweep(self, sweep, channel=0):
+        return self._sweeps[channel][sweep]
+
+    def channel(self, channel):
+        if len(self._sweeps[channel]) > 1:
+            raise ValueError('{} has {} sweeps of {}; use sweep()'.format(self.path, len(self._sweeps[channel]), self.channel_names[channel]))
+        return self._sweeps[channel][0]
+
+
+def open_recording(path):
+    # PURPOSE: AbfRecording or AxographRecording, by file extension
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.abf':
+        return AbfRecording(path)
+    if extension in ('.axgd', '.axgx', '.axg'):
+        return AxographRecording(path)
+    raise ValueError('unknown recording type: ' + path)
+
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+    from timeit import default_timer as timer
+
+    if len(sys.argv) > 1:
+        start = timer()
+        rec = open_recording(sys.argv[1])
+        print('opened in {:.1f} ms: {} channels {} ({}), {} sweeps of {} points at {:g} Hz'.format(
+            1e3*(timer() - start), rec.channel_count, rec.channel_names, rec.units, rec.sweep_count, rec.sweep_points, rec.rate))
+        sys.exit()
+
+    # open time against file size, and against pyabf loading the data
+    from pyabf.abfWriter import writeABF1
+    folder = tempfile.mkdtemp()
+    for sweeps in (10, 100, 1000):
+        path = os.path.join(folder, '{}.abf'.format(sweeps))
+        data = np.random.default_rng(0).normal(-65, 5, (sweeps, 20000)).astype('float32')
+        writeABF1(data, path, 20000, units='mV')
+        start = timer()
+        rec = open_recording(path)
+        t_open = timer() - start
+        start = timer()
+        abf = pyabf.ABF(path)
+        t_pyabf = timer() - start
+        abf.setSweep(sweeps - 1)
+        assert np.allclose(rec.sweep(sweeps - 1), abf.sweepY, atol=1e-3)
+        print('{:6.1f} MB: open {:6.2f} ms   pyabf.ABF {:7.1f} ms'.format(os.path.getsize(path)/1e6, 1e3*t_open, 1e3*t_pyabf))
@@ -0,0 +1,102 @@
+"""
+    Edge-preserving smoothing backends for cell detection.
+
+    The detector smooths the normalized frame with
+    cv2.bilateralFilter(image, d, sigmaColor, sigmaSpace), with d, sigmaColor
+    and sigmaSpace proportional to the frame height. Its cost grows with the
+    pixel count times d^2, so it is the slowest step on full-resolution
+    camera frames. Three backends take the same parameters:
+
+        'bilateral'     the exact cv2.bilateralFilter (default)
+        'downsampled'   bilateral filter on a frame shrunk by `factor`
+                        (INTER_AREA) with d and sigmaSpace divided by factor,
+                        then enlarged back (INTER_LINEAR): factor^4 less work
+        'guided'        self-guided filter (He et al. 2010) built from
+                        cv2.boxFilter, O(pixels) whatever the radius, with
+                        eps = sigmaColor^2 playing the part of the range kernel
+
+    With the GUI defaults sigmaColor is much larger than the [0, 1] intensity
+    range, so the range kernel is nearly flat and all three behave like a
+    disk average of diameter d; smaller sigmaColor makes them preserve edges.
+
+    Run this file to benchmark speed and detection agreement with the exact
+    filter on the bundled images/ set.
+"""
+import cv2
+import numpy as np
+
+BACKENDS = ('bilateral', 'downsampled', 'guided')
+
+
+def guided_filter(image, radius, eps):
+    # PURPOSE: self-guided filter of a float32 image with a (2*radius + 1)^2 box
+    size = (2*radius + 1, 2*radius + 1)
+    mean = cv2.boxFilter(image, -1, size)
+    var = cv2.boxFilter(image*image, -1, size) - mean*mean
+    a = var/(var + eps)
+    b = mean - a*mean
+    return cv2.boxFilter(a, -1, size)*image + cv2.boxFilter(b, -1, size)
+
+
+def smooth(norm_image, row, scolor=.034, sspace=.019, backend='bilateral', factor=4, scale=1.):
+    # PURPOSE: the detection filter. row is the height of the whole frame (also when norm_image is a crop of it).
+    # Same arguments as cv2.bilateralFilter(norm_image, int(scolor*row), int(sspace*row), int(.019*row)).
+    # scale: the value that stands for 1 in norm_image, e.g. the raw frame with scale = its maximum gives the
+    # filtered normalized frame times scale, without making the normalized copy.
+    image = norm_image.astype('float32', copy=False)
+    d, sigma_color, sigma_space = int(scolor*row), int(sspace*row)*scale, int(.019*row)
+    if backend == 'bilateral':
+        return cv2.bilateralFilter(image, d, sigma_color, sigma_space)
+    if backend == 'downsampled':
+        h, w = image.shape[:2]
+        small = cv2.resize(image, (max(1, round(w/factor)), max(1, round(h/factor))), interpolation=cv2.INTER_AREA)
+        small = cv2.bilateralFilter(small, max(1, round(d/factor)), sigma_color, max(1., sigma_space/factor))
+        return cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+    if backend == 'guided':
+        # two box passes of radius .3*d spread about as far as the disk of diameter d
+        return guided_filter(image, max(1, round(.3*d)), float(sigma_color)**2)
+    raise ValueError('unknown smoothing backend {!r}, expected one of {}'.format(backend, BACKENDS))
+
+
+if __name__ == '__main__':
+    import os
+    from timeit import default_timer as timer
+    from PIL import Image
+    from detection import find_cells
+    from tracking import match
+
+    def detect(image, backend, threshold_perc=97.0):
+        norm_image = image/np.max(image)
+        start = timer()
+        filtered = smooth(norm_image, image.shape[0], backend=backend)
+        seconds = timer() - start
+        ret, mask = cv2.threshold(filtered, np.quantile(norm_image, threshold_perc/100), 1, cv2.THRESH_BINARY)
+        cells, labels = find_cells(mask)
+        return cells, mask, seconds
+
+    folder = 'images'
+    names = sorted(f for f in os.listdir(folder) if f.lower().endswith(('.png', '.tif', '.tiff', '.jpg')))
+    for size in (None, (1280, 1024)): # bundled size and camera size
+        print('images/ at {}:'.format('native size' if size is None else '{}x{}'.format(*size)))
+        print('{:>12} {:>10} {:>8} {:>14} {:>10}'.format('backend', 'filter[ms]', 'speedup', 'cells matched', 'mask IoU'))
+        totals = {b: [0., 0, 0, 0, 0.] for b in BACKENDS} # seconds, exact cells, cells, matched, IoU sum
+        for name in names:
+            image = Image.open(os.path.join(folder, name)).convert('L')
+            if size is not None:
+                image = image.resize(size)
+            image = np.array(image)
+            exact, exact_mask, t_exact = detect(image, 'bilateral')
+            for backend in BACKENDS:
+                cells, mask, seconds = (exact, exact_mask, t_exact) if backend == 'bilateral' else detect(image, backend)
+                rows, cols = match(np.column_stack([exact['cx'], exact['cy']]), np.column_stack([cells['cx'], cells['cy']]), 5.)
+                union = np.count_nonzero(mask + exact_mask)
+                t = totals[backend]
+                t[0] += seconds
+                t[1] += len(exact)
+                t[2] += len(cells)
+                t[3] += len(rows)
+                t[4] += np.count_nonzero(mask*exact_mask)/union if union else 1.
+        for backend in BACKENDS:
+            seconds, n_exact, n, matched, iou = totals[backend]
+            print('{:>12} {:>10.1f} {:>7.1f}x {:>6}/{:<3}({:>2}) {:>10.3f}'.format(backend, 1e3*seconds/len(names),
+                  totals['bilateral'][0]/seconds, matched, n_exact, n, iou/len(names)))
@@ -0,0 +1,207 @@
+"""
+    Action potential detection and features.
+
+    detect_spikes() works on a whole sweep with array operations, no loop over
+    spikes. A spike is an upward crossing of `level` that comes back down
+    within max_width. Its features are measured in fixed-size windows gathered
+    around all crossings at once:
+
+        threshold    voltage where dV/dt first exceeds dvdt_threshold before the peak [mV]
+        peak         maximum between the crossings [mV]
+        amplitude    peak - threshold [mV]
+        half_width   width at (threshold + peak)/2, interpolated [s]
+        ahp          threshold - minimum after the peak (up to the next spike or ahp_window) [mV]
+        max_dvdt     fastest rise [mV/ms]
+        isi          time since the previous spike of the same sweep [s]
+
+    analyze_files() runs every sweep of many recordings (recording.py) on a
+    process pool; long gap-free sweeps are split into overlapping chunks so
+    one file also spreads over the workers. Results are one SPIKE_DTYPE array.
+
+    Run this file to benchmark the cost per hour of recording.
+"""
+from multiprocessing import Pool
+import numpy as np
+from recording import open_recording
+
+SPIKE_DTYPE = np.dtype([('file', 'i4'), ('channel', 'i2'), ('sweep', 'i4'), ('index', 'i8'), ('time', 'f8'),
+                        ('threshold', 'f4'), ('peak', 'f4'), ('amplitude', 'f4'), ('half_width', 'f4'),
+                        ('ahp', 'f4'), ('max_dvdt', 'f4'), ('isi', 'f4')])
+
+DEFAULTS = dict(level=-20., dvdt_threshold=20., max_width=.005, onset_window=.003, ahp_window=.05)
+
+
+def _windows(starts, length, size):
+    # (n, length) sample indices starts[:, None] + 0..length-1, clipped to the trace, and the in-range mask
+    idx = starts[:, None] + np.arange(length)
+    inside = (idx >= 0) & (idx < size)
+    return np.clip(idx, 0, size - 1), inside
+
+
+def detect_spikes(v, rate, level=-20., dvdt_threshold=20., max_width=.005, onset_window=.003, ahp_window=.05, keep=None):
+    # PURPOSE: SPIKE_DTYPE array for one trace (index/time relative to v[0]). keep=(start, stop) only reports
+    # spikes crossing level in that sample range (used for chunks with overlap). file/channel/sweep/isi are left 0.
+    v = np.asarray(v, dtype='float32')
+    dvdt = np.diff(v)*np.float32(rate/1000.) # mV/ms; dvdt[i] is the slope from v[i] to v[i+1]
+    above = v >= level
+    up = np.flatnonzero(~above[:-1] & above[1:]) + 1
+    down = np.flatnonzero(above[:-1] & ~above[1:]) + 1
+    j = np.searchsorted(down, up)
+    ok = j < len(down) # drop a crossing still above level at the end of the trace
+    up, down = up[ok], down[j[ok]]
+    ok = down - up <= max_width*rate
+    up, down = up[ok], down[ok]
+    n = len(up)
+    spikes = np.zeros(n, dtype=SPIKE_DTYPE)
+    if n == 0:
+        return spikes
+    rows = np.arange(n)
+
+    # peak: argmax between the crossings
+    idx, inside = _windows(up, int((down - up).max()), len(v))
+    inside &= idx < down[:, None]
+    peak_i = idx[rows, np.where(inside, v[idx], -np.inf).argmax(1)]
+    peak = v[peak_i]
+
+    # threshold: walking back from the crossing, the first sample rising slower than dvdt_threshold marks the
+    # onset (one sample later). The search stops at the previous spike.
+    back = int(onset_window*rate)
+    lo = np.maximum(up - back, np.r_[0, down[:-1]])
+    idx, inside = _windows(up - back, back, len(dvdt))
+    idx, inside = idx[:, ::-1], inside[:, ::-1] # nearest first
+    slow = inside & (idx >= lo[:, None]) & (dvdt[idx] < dvdt_threshold)
+    onset = np.where(slow.any(1), idx[rows, slow.argmax(1)] + 1, lo)
+    threshold = v[onset]
+
+    # half width: linear interpolation at the half amplitude level on both flanks
+    half = (threshold + peak)/2
+    span = int((peak_i - onset).max()) + 1
+    idx, inside = _windows(peak_i - span + 1, span, len(v))
+    idx, inside = idx[:, ::-1], inside[:, ::-1] # from the peak backwards
+    below = inside & (idx >= onset[:, None]) & (v[idx] < half[:, None])
+    r0 = idx[rows, below.argmax(1)]
+    r1 = np.minimum(r0 + 1, len(v) - 1)
+    rise = r0 + (half - v[r0])/np.maximum(v[r1] - v[r0], 1e-6)
+    idx, inside = _windows(peak_i, int(max_width*rate) + 1, len(v))
+    below = inside & (v[idx] < half[:, None])
+    f1 = idx[rows, below.argmax(1)]
+    f0 = np.maximum(f1 - 1, 0)
+    fall = f0 + (v[f0] - half)/np.maximum(v[f0] - v[f1], 1e-6)
+    half_width = np.where(below.any(1) & (f1 > peak_i), (fall - rise)/rate, np.nan)
+
+    # after-hyperpolarization and fastest rise, one reduceat each over [peak, end) and [onset, peak)
+    end = np.minimum(peak_i + int(ahp_window*rate), np.r_[onset[1:], len(v)])
+    end = np.maximum(np.minimum(end, len(v) - 1), peak_i + 1)
+    trough = np.minimum.reduceat(v, np.column_stack([peak_i, end]).ravel())[0::2]
+    start = np.minimum(onset, peak_i - 1)
+    max_dvdt = np.maximum.reduceat(dvdt, np.column_stack([start, np.minimum(peak_i, len(dvdt) - 1)]).ravel())[0::2]
+
+    spikes['index'] = peak_i
+    spikes['time'] = peak_i/rate
+    spikes['threshold'] = threshold
+    spikes['peak'] = peak
+    spikes['amplitude'] = peak - threshold
+    spikes['half_width'] = half_width
+    spikes['ahp'] = threshold - trough
+    spikes['max_dvdt'] = max_dvdt
+    if keep is not None:
+        spikes = spikes[(up >= keep[0]) & (up < keep[1])]
+    return spikes
+
+
+def set_isi(spikes):
+    # PURPOSE: fill the isi column, in place. spikes must be sorted by file, channel, sweep, time.
+    isi = np.empty(len(spikes), dtype='float64')
+    isi[:1] = np.nan
+    isi[1:] = np.diff(spikes['time'])
+    same = np.ones(len(spikes), dtype=bool)
+    for field in ('file', 'channel', 'sweep'):
+        same[1:] &= spikes[field][1:] == spikes[field][:-1]
+    isi[~same] = np.nan
+    spikes['isi'] = isi
+    return spikes
+
+
+def _tasks(paths, channels, chunk_seconds, params):
+    # one task per (file, channel, sweep, chunk); chunks overlap by the longest window so no spike is cut
+    pad_before = params['onset_window'] + params['max_width']
+    pad_after = params['max_width'] + params['ahp_window']
+    tasks = []
+    for f, path in enumerate(paths):
+        rec = open_recording(path)
+        chunk = int(chunk_seconds*rec.rate)
+        for channel in (range(rec.channel_count) if channels is None else channels):
+            for sweep in range(rec.sweep_count):
+                for start in range(0, rec.sweep_points, chunk):
+                    stop = min(start + chunk, rec.sweep_points)
+                    tasks.append((f, path, channel, sweep, start, stop,
+                                  int(pad_before*rec.rate), int(pad_after*rec.rate), params))
+    return tasks
+
+
+def _analyze(task):
+    f, path, channel, sweep, start, stop, pad_before, pad_after, params = task
+    rec = open_recording(path) # constant time, only the slice below is read
+    trace = rec.sweep(sweep, channel)
+    lo, hi = max(start - pad_before, 0), min(stop + pad_after, len(trace))
+    spikes = detect_spikes(trace[lo:hi], rec.rate, keep=(start - lo, stop - lo), **params)
+    spikes['file'] = f
+    spikes['channel'] = channel
+    spikes['sweep'] = sweep
+    spikes['index'] += lo
+    spikes['time'] = spikes['index']/rec.rate
+    return spikes
+
+
+def analyze_files(paths, channels=(0,), processes=None, chunk_seconds=60., **params):
+    # PURPOSE: spikes of every sweep of every recording, as one SPIKE_DTYPE array (file = index into paths).
+    # channels=None analyzes every channel. params override DEFAULTS.
+    params = dict(DEFAULTS, **params)
+    tasks = _tasks(paths, channels, chunk_seconds, params)
+    if processes == 1:
+        results = list(map(_analyze, tasks))
+    else:
+        with Pool(processes) as pool:
+            results = pool.map(_analyze, tasks, chunksize=max(1, len(tasks)//(8*(processes or 4))))
+    spikes = np.concatenate(results) if results else np.zeros(0, dtype=SPIKE_DTYPE)
+    return set_isi(spikes)
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+    from timeit import default_timer as timer
+    from pyabf.abfWriter import writeABF1
+
+    rate = 20000
+    t = np.arange(int(.02*rate))/rate*1e3 # ms
+    # template: slow ramp to threshold (-50 mV), fast rise to +30 mV, repolarization to a -72 mV AHP
+    template = np.interp(t, [0, 2, 2.5, 3.5, 5, 20], [-65, -50, 30, -40, -72, -65]).astype('float32')
+
+    def synthetic(seconds, spike_rate, seed):
+        rng = np.random.default_rng(seed)
+        v = rng.normal(-65, .5, int(seconds*rate)).astype('float32')
+        onsets = np.sort(rng.choice(np.arange(0, len(v) - len(template), len(template)), int(seconds*spike_rate), replace=False))
+        v[onsets[:, None] + np.arange(len(template))] += template + 65
+        return v, onsets
+
+    folder = tempfile.mkdtemp()
+    minutes, files = 5, 2
+    paths, truth = [], 0
+    for i in range(files):
+        v, onsets = synthetic(60*minutes, 5., i)
+        truth += len(onsets)
+        path = os.path.join(folder, 'cell{}.abf'.format(i))
+        writeABF1(v.reshape(-1, 10*rate), path, rate, units='mV') # 10 s sweeps
+        paths.append(path)
+    hours = files*minutes/60.
+
+    for processes in (1, None):
+        start = timer()
+        spikes = analyze_files(paths, processes=processes)
+        seconds = timer() - start
+        print('{} processes: {} spikes ({} injected) in {:.2f} s --> {:.1f} s per hour of recording'.format(
+            processes or os.cpu_count(), len(spikes), truth, seconds, seconds/hours))
+    for field in ('threshold', 'peak', 'amplitude', 'half_width', 'ahp', 'max_dvdt', 'isi'):
+        print('{:>10}: median {:.4g}'.format(field, np.nanmedian(spikes[field])))
+    print('template:  threshold -50 mV, peak 30 mV, half width ~0.8 ms, AHP ~22 mV, max dV/dt 160 mV/ms (+ noise)')
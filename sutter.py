@@ -4,12 +4,51 @@ Created on Thu Mar 30 19:22:05 2017
 @author: nzj
 """
 
+import collections
+import heapq
+import itertools
+import struct
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
 import serial as srl
 
+CF = 0.0625 # conversion factor microsteps-->microns
+
+def pack_move( x, y, z ):
+    # build an 'M' (move) command for a position given in microns: 'M' + x, y, z as uint32 little endian microsteps
+    return b'M' + struct.pack('<III', *[int(round(v/CF)) for v in (x, y, z)])
+
+def decode_position( packet ):
+    # 14 byte 'C' reply: drive number, x, y, z (uint32 little endian microsteps), CR --> (x, y, z) in microns
+    drive, x, y, z = struct.unpack('<BIII', bytes(packet[:13]))
+    return (x*CF, y*CF, z*CF)
+
+PACKET_DTYPE = np.dtype([('drive', 'u1'), ('x', '<u4'), ('y', '<u4'), ('z', '<u4'), ('cr', 'u1')]) # one 'C' reply
+TRAJECTORY_DTYPE = np.dtype([('t', 'f8'), ('x', 'f8'), ('y', 'f8'), ('z', 'f8')]) # perf_counter stamp, microns
+
+class MoveInterrupted(Exception):
+    # raised by the Future of a move that Interrupt() stopped partway
+    pass
+
+def decode_positions( buffer ):
+    # any number of back to back 14 byte 'C' replies --> (n, 3) array of x, y, z in microns, in one pass
+    packets = np.frombuffer(buffer, dtype=PACKET_DTYPE, count=len(buffer)//PACKET_DTYPE.itemsize)
+    if np.any(packets['cr'] != 13):
+        raise ValueError('position packets out of step (no CR at byte 13)')
+    positions = np.empty((len(packets), 3))
+    positions[:, 0] = packets['x']
+    positions[:, 1] = packets['y']
+    positions[:, 2] = packets['z']
+    positions *= CF
+    return positions
+
 
 class Sutter_driver:  
     def __init__(self, port, baudrate,bytesize,stopbits,Ans = 0):
-        self.obj = srl.Serial(port=port,baudrate=baudrate,bytesize=bytesize,stopbits=stopbits,timeout=3) 
+        # port is a device name ('COM3') or any pyserial URL, e.g. socket://127.0.0.1:port for sutter_sim.py
+        self.obj = srl.serial_for_url(port,baudrate=baudrate,bytesize=bytesize,stopbits=stopbits,timeout=3) 
         self.__Ans__ = Ans
         print((self.obj.portstr,'create successful'))
 
@@ -51,6 +90,399 @@ class Sutter_driver:
     def Interrupt( self ):
         self.obj.write(b'\x03')
         return self.WaitAnswer()
+
+MOVES = (b'M', b'H', b'Y') # commands that answer only once the move is done
+INTERRUPT = b'\x03'
+CR = 13
+
+
+class Position_Log:
+    # Preallocated trajectory written by Async_Sutter's position stream: one TRAJECTORY_DTYPE row per reply,
+    # stamped with the time its request was sent. Samples past capacity are counted in dropped, not stored.
+    def __init__( self, capacity ):
+        self.rows = np.zeros(capacity, dtype=TRAJECTORY_DTYPE)
+        self.count = 0
+        self.dropped = 0
+        self.late = 0 # polls skipped: the controller had not answered the earlier ones yet, or does not answer during moves
+
+    def append( self, stamps, positions ):
+        n = min(len(stamps), len(self.rows) - self.count)
+        block = self.rows[self.count:self.count + n]
+        block['t'] = stamps[:n]
+        block['x'] = positions[:n, 0]
+        block['y'] = positions[:n, 1]
+        block['z'] = positions[:n, 2]
+        self.count += n # published after the rows are written, so data() never shows a half written row
+        self.dropped += len(stamps) - n
+
+    def data( self ):
+        # the rows logged so far (a view; copy it to keep it past the next StartStream)
+        return self.rows[:self.count]
+
+    def rate( self ):
+        # achieved sample rate [Hz]
+        t = self.rows['t'][:self.count]
+        return (len(t) - 1)/(t[-1] - t[0]) if len(t) > 1 else 0.
+
+
+class Async_Sutter:
+    # Non-blocking front end for a Sutter_driver. One worker thread owns the port and runs commands in order;
+    # every call returns a concurrent.futures.Future right away, so Tk callbacks never wait on the serial port.
+    # Interrupt() stops the move in progress at once (its Future fails with MoveInterrupted) and cancels the moves
+    # still queued.
+    # Subscribe(callback) gets callback(timestamp, (x, y, z) microns) from the worker thread on every position read.
+    # StartStream(rate) polls the position at a fixed rate into a Position_Log, also while moves run; commands
+    # keep working in between. A controller that does not answer 'C' during a move leaves a gap in the log for
+    # each move, the moves themselves are not affected.
+    def __init__( self, driver ):
+        self.driver = driver
+        self.obj = driver.obj
+        self.subscribers = []
+        self._heap = [] # (priority, sequence, command, reply length, future)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._moving = False
+        self._interrupt_sent = False
+        self._stopping = False # Interrupt() was called while a move ran: that move ends with MoveInterrupted
+        self._closed = False
+        self._stream = None # (period, Position_Log) while streaming
+        self._stream_done = None # Future for the Position_Log, resolved once the stream has drained
+        self._quiet = False # found out while streaming: the controller does not answer 'C' during a move
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def _submit( self, command, reply_len, priority=1 ):
+        fut = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Async_Sutter is closed')
+            heapq.heappush(self._heap, (priority, next(self._seq), command, reply_len, fut))
+            self._cond.notify()
+        return fut
+
+    def Subscribe( self, callback ):
+        self.subscribers.append(callback)
+
+    def Unsubscribe( self, callback ):
+        self.subscribers.remove(callback)
+
+    def _publish( self, stamp, position ):
+        for callback in list(self.subscribers):
+            try:
+                callback(stamp, position)
+            except Exception as e:
+                print('position subscriber failed:', e)
+
+    def CurrentPos( self ):
+        # Future --> (x, y, z) in microns
+        return self._submit(b'C', 14)
+
+    def Move2Pos( self, x, y, z ):
+        # Future --> None when the move is done. Position in microns.
+        return self._submit(pack_move(x, y, z), 1)
+
+    def MovePath( self, points ):
+        # Future --> None once the pipette has gone through every (x, y, z) point in turn (microns). Each leg is
+        # sent when the one before it has ended, so a leg that fails, or is stopped or cancelled by Interrupt(),
+        # ends the path there and the returned Future fails or is cancelled the same way.
+        path = Future()
+        points = list(points)
+        def leg( previous=None ):
+            if path.cancelled():
+                return
+            if previous is not None and previous.cancelled():
+                path.cancel()
+            elif previous is not None and previous.exception() is not None:
+                path.set_exception(previous.exception())
+            elif not points:
+                path.set_result(None)
+            else:
+                try:
+                    self.Move2Pos(*points.pop(0)).add_done_callback(leg)
+                except RuntimeError as e: # closed
+                    path.set_exception(e)
+        leg()
+        return path
+
+    def Move2Home( self ):
+        return self._submit(b'H', 1)
+
+    def Move2Work( self ):
+        return self._submit(b'Y', 1)
+
+    def Calibration( self ):
+        return self._submit(b'N', 1)
+
+    def ChangeManipulator( self, drive ):
+        return self._submit(b'I' + bytes([drive]), 1)
+
+    def Interrupt( self ):
+        # jumps ahead of everything queued; a move in progress is stopped right away
+        with self._cond:
+            kept = []
+            for item in self._heap:
+                if item[2][:1] in MOVES:
+                    item[4].cancel()
+                else:
+                    kept.append(item)
+            self._heap = kept
+            heapq.heapify(self._heap)
+            if self._moving:
+                self._stopping = True
+            if self._moving and not self._interrupt_sent:
+                self.obj.write(INTERRUPT) # the worker is blocked reading the move's answer
+                self._interrupt_sent = True
+            fut = Future()
+            heapq.heappush(self._heap, (0, next(self._seq), INTERRUPT, 1, fut))
+            self._cond.notify()
+        return fut
+
+    def StartStream( self, rate=500., capacity=600000 ):
+        # poll the position rate times per second into a new Position_Log (returned, filled as replies arrive)
+        log = Position_Log(capacity)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Async_Sutter is closed')
+            if self._stream is not None or (self._stream_done is not None and not self._stream_done.done()):
+                raise RuntimeError('position stream already running')
+            self._stream = (1./rate, log)
+            self._stream_done = Future()
+            self._cond.notify()
+        return log
+
+    def StopStream( self ):
+        # Future --> the Position_Log, once the replies still in flight are logged
+        with self._cond:
+            done = self._stream_done
+            self._stream = None
+            self._cond.notify()
+        if done is None:
+            raise RuntimeError('no position stream running')
+        return done
+
+    def Close( self ):
+        # stops the worker after the commands already queued; the driver (port) stays open
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._worker.join()
+
+    def _move_stopped( self ):
+        # True if the move that just ended was stopped by Interrupt(); clears the flag for the next move
+        with self._cond:
+            stopped = self._stopping
+            self._stopping = False
+        return stopped
+
+    def _read( self, n, wait_forever=False ):
+        reply = self.obj.read(n)
+        while wait_forever and len(reply) < n and not self._closed: # moves can outlast the port timeout
+            reply += self.obj.read(n - len(reply))
+        if len(reply) < n:
+            raise TimeoutError('no answer from controller')
+        return reply
+
+    def _run( self ):
+        while True:
+            with self._cond:
+                while not self._heap and not self._closed and self._stream is None:
+                    self._cond.wait()
+                if self._stream is not None and not self._closed:
+                    log, done = self._stream[1], self._stream_done
+                    command = None
+                elif not self._heap: # closed and nothing left
+                    return
+                else:
+                    priority, seq, command, reply_len, fut = heapq.heappop(self._heap)
+                    if not fut.set_running_or_notify_cancel():
+                        continue
+                    is_move = command[:1] in MOVES
+                    early = command == INTERRUPT and self._interrupt_sent
+                    self._moving = is_move
+                    if not early:
+                        self.obj.write(command) # written under the lock so Interrupt() sees _moving in sync
+            if command is None:
+                self._run_stream()
+                done.set_result(log)
+                continue
+            try:
+                reply = self._read(reply_len, wait_forever=is_move)
+                if command == b'C':
+                    position = decode_position(reply)
+                    self._publish(time.perf_counter(), position)
+                    fut.set_result(position)
+                elif is_move and self._move_stopped():
+                    fut.set_exception(MoveInterrupted('move stopped before reaching its target'))
+                else:
+                    fut.set_result(None)
+            except Exception as e:
+                if is_move:
+                    self._move_stopped()
+                fut.set_exception(e)
+            finally:
+                with self._cond:
+                    self._moving = False
+                    if command == INTERRUPT:
+                        self._interrupt_sent = False
+
+    def _run_stream( self ):
+        # Fixed rate 'C' polling without waiting for the answers. Every request written is recorded in `expected`
+        # (in the order the controller answers them) and the incoming bytes are matched against it, so polls,
+        # queued commands and a move's final CR share the port. Consecutive poll answers are decoded as one batch.
+        # If position requests go unanswered during a move, the controller is taken not to answer them while
+        # moving: the move goes on, and from then on nothing is polled until a move ends.
+        expected = collections.deque() # (kind, stamp or future): 'poll', 'C' (CurrentPos) or 'CR' (one byte answer)
+        move = None # future of the move in progress; its CR can arrive between two position packets
+        quiet = self._quiet # the controller does not answer position requests during moves
+        stale = 0 # requests sent during the last move and not answered yet; nothing else goes out meanwhile
+        rx = bytearray()
+        period = self._stream[0]
+        next_poll = last_rx = time.perf_counter()
+        port_timeout = self.obj.timeout
+        self.obj.timeout = 0 # reads return what has arrived; the ticks below do the waiting
+        try:
+            while True:
+                with self._cond:
+                    stream = self._stream if not self._closed else None
+                    if stream is None and not expected and move is None and not self._heap:
+                        self._stream = None # also when stopped by Close()
+                        return
+                    now = time.perf_counter()
+                    if (not self._heap or stale or quiet and move is not None) and now < next_poll:
+                        self._cond.wait(next_poll - now)
+                    if not stale:
+                        move = self._dispatch_streaming(expected, move, quiet)
+                    hold = stale > 0 or (quiet and move is not None) # no polls now
+                    now = time.perf_counter()
+                    if now >= next_poll:
+                        if stream is not None:
+                            log = stream[1]
+                            if sum(1 for kind, obj in expected if kind == 'poll') < 4 and not hold:
+                                self.obj.write(b'C')
+                                expected.append(('poll', now))
+                            else:
+                                log.late += 1
+                        next_poll += period
+                        if next_poll < now: # fell more than a period behind: restart the schedule from now
+                            next_poll = now + period
+                try:
+                    data = self.obj.read(4096)
+                    if data:
+                        rx += data
+                        last_rx = now
+                    elif expected and now - last_rx > port_timeout:
+                        positions_only = all(kind != 'CR' for kind, obj in expected)
+                        if move is not None and positions_only:
+                            quiet = self._quiet = True # not an error: wait for the move's CR, no more polls until then
+                        elif stale:
+                            # the requests sent during the move were dropped by the controller
+                            quiet = self._quiet = True
+                            for kind, obj in expected:
+                                if kind == 'C':
+                                    obj.set_exception(TimeoutError('no answer from controller during a move'))
+                                elif stream is not None:
+                                    stream[1].late += 1
+                            expected.clear()
+                            stale = 0
+                        else:
+                            raise TimeoutError('no answer from controller')
+                    elif not expected:
+                        last_rx = now
+                    moving = move is not None
+                    move = self._parse_stream(rx, expected, move, stream[1] if stream else None)
+                    if moving and move is None:
+                        stale = len(expected) # the move ended; requests sent during it are answered after its CR, if at all
+                    stale = min(stale, len(expected))
+                except Exception as e:
+                    for kind, obj in expected:
+                        if kind != 'poll':
+                            obj.set_exception(e)
+                    expected.clear()
+                    stale = 0
+                    if move is not None:
+                        self._move_stopped()
+                        move.set_exception(e)
+                        move = None
+                    rx.clear()
+                    with self._cond:
+                        self._moving = False
+                        self._stream = None
+        finally:
+            self.obj.timeout = port_timeout
+
+    def _dispatch_streaming( self, expected, move, quiet=False ):
+        # write the queued commands that can go out now (called with the lock held). While a move runs the
+        # controller only answers 'C' (not even that when quiet) and interrupts, so anything else waits for the
+        # move to end.
+        while self._heap:
+            command = self._heap[0][2]
+            if move is not None and command != INTERRUPT and (quiet or command != b'C'):
+                break
+            priority, seq, command, reply_len, fut = heapq.heappop(self._heap)
+            if not fut.set_running_or_notify_cancel():
+                continue
+            if command == INTERRUPT and self._interrupt_sent:
+                self._interrupt_sent = False # already written by Interrupt()
+            else:
+                self.obj.write(command)
+            if command[:1] in MOVES:
+                move = fut
+            else:
+                expected.append(('C' if command == b'C' else 'CR', fut))
+        self._moving = move is not None
+        return move
+
+    def _parse_stream( self, rx, expected, move, log ):
+        # consume complete answers from the front of rx; returns the move future if that move is still running
+        size = PACKET_DTYPE.itemsize
+        while rx:
+            if rx[0] == CR and move is not None: # a packet starts with its drive number, never with CR
+                del rx[:1]
+                with self._cond:
+                    self._moving = False
+                if self._move_stopped():
+                    move.set_exception(MoveInterrupted('move stopped before reaching its target'))
+                else:
+                    move.set_result(None)
+                move = None
+                continue
+            if not expected:
+                del rx[:1] # stray byte
+                continue
+            kind, obj = expected[0]
+            if kind == 'CR':
+                del rx[:1]
+                expected.popleft()
+                obj.set_result(None)
+                continue
+            if len(rx) < size:
+                break
+            if kind == 'C':
+                position = decode_position(rx[:size])
+                del rx[:size]
+                expected.popleft()
+                self._publish(time.perf_counter(), position)
+                obj.set_result(position)
+                continue
+            n = 0 # run of poll answers at the front, decoded together
+            for kind, obj in expected:
+                if kind != 'poll':
+                    break
+                n += 1
+            n = min(n, len(rx)//size)
+            if move is not None: # stop before a move's CR sitting on a packet boundary
+                starts = rx[:n*size:size]
+                if CR in starts:
+                    n = starts.index(CR)
+            if n == 0:
+                continue
+            positions = decode_positions(rx[:n*size])
+            stamps = np.array([expected.popleft()[1] for i in range(n)])
+            del rx[:n*size]
+            if log is not None:
+                log.append(stamps, positions)
+            self._publish(stamps[-1], tuple(positions[-1]))
+        return move
     
 
 if __name__ == '__main__':
@@ -59,14 +491,16 @@ if __name__ == '__main__':
 
     pos = p.CurrentPos()
     print('pos = ', pos)
-    posArray = bytearray(pos)
-    driveNum = posArray[0]
-    xByte = posArray[1:4]
-    yByte = posArray[5:8]
-    zByte = posArray[9:12]
-    x_um_step = int.from_bytes(xByte,byteorder='little',signed=False)
-    print('x (microsteps):', x_um_step)
-    x_micron = x_um_step*.0625
-    print('x (micron):', x_micron)
+    packet = np.frombuffer(pos, dtype=PACKET_DTYPE)[0] # x, y, z are full 4 byte fields (bytes 1:5, 5:9, 9:13)
+    print('drive:', packet['drive'])
+    print('x (microsteps):', packet['x'])
+    print('x, y, z (micron):', decode_position(pos))
+
+    sutter = Async_Sutter(p)
+    log = sutter.StartStream(rate=200)
+    time.sleep(2)
+    sutter.StopStream().result()
+    sutter.Close()
+    print('{} positions in 2 s ({:.0f} Hz)'.format(log.count, log.rate()))
 
     print('done')
@@ -0,0 +1,234 @@
+"""
+    Simulated Sutter MPC-325 controller.
+
+    Serves the controller's byte protocol on a local TCP port so that
+    Sutter_driver (and everything built on it) can run without the rig, through
+    pyserial's socket:// URL support:
+
+        sim = SutterSimulator(speed=1300, latency=.002).start()
+        p = Sutter_driver(port=sim.url, baudrate=128000, bytesize=8, stopbits=1, Ans=1)
+
+    Commands (https://www.sutter.com/manuals/MPC-325_OpMan.pdf), replies end in CR:
+        'C'                   current position: drive byte + x, y, z (uint32 LE microsteps) + CR (14 bytes)
+        'M' + x, y, z         straight line move at the configured speed, CR when done
+        'I' + drive           select the active manipulator (1-4)
+        'H' / 'Y'             move to home / work position
+        'N'                   calibrate (re-zero the active drive)
+        0x03                  interrupt: stops a move in progress where it is
+    While moving, 'C' is answered with the position along the move (for position
+    streaming), or dropped with answer_during_move=False (whether the real
+    controller answers it during a move is not known); other commands wait
+    until the move is done.
+    Run this file to measure command round trip, move timing and position streaming.
+"""
+import socket
+import struct
+import threading
+import time
+import numpy as np
+from sutter import CF, pack_move
+
+CR = b'\r'
+MOVE_BYTES = 13 # 'M' + 3 x uint32
+
+
+class SutterSimulator(object):
+    def __init__(self, speed=1300.0, latency=.002, host='127.0.0.1', port=0, home=(0, 0, 0), work=(6400, 6400, 6400),
+                 answer_during_move=True):
+        self.speed = speed # move speed [um/s]
+        self.latency = latency # controller processing time before every reply [s]
+        self.answer_during_move = answer_during_move # False: 'C' sent during a move is dropped without an answer
+        self.home = np.array(home, dtype='float64') # microsteps
+        self.work = np.array(work, dtype='float64')
+        self.drive = 1
+        self.positions = {d: self.home.copy() for d in range(1, 5)} # microsteps, per drive
+        self.commands = 0 # commands handled, for tests
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((host, port))
+        self._server.listen(1)
+        self.host, self.port = self._server.getsockname()
+        self._lock = threading.Lock()
+        self._move = None # (start time, start position, end position, duration) while moving
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+
+    @property
+    def url(self):
+        return 'socket://{}:{}'.format(self.host, self.port)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._server.close()
+        self._thread.join(1)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def position(self, now=None):
+        # PURPOSE: position of the active drive in microsteps, interpolated along a move in progress
+        with self._lock:
+            if self._move is None:
+                return self.positions[self.drive].copy()
+            t0, p0, p1, duration = self._move
+            f = min(1., ((time.perf_counter() if now is None else now) - t0)/duration)
+            return p0 + (p1 - p0)*f
+
+    def position_microns(self):
+        return self.position()*CF
+
+    def _serve(self):
+        while not self._stop.is_set():
+            try:
+                conn, addr = self._server.accept()
+            except OSError: # server socket closed by stop()
+                return
+            with conn:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self._handle(conn)
+
+    def _read(self, conn, buf, n, deadline=None):
+        # block until buf holds n bytes; returns False if the deadline passes first, raises ConnectionError on disconnect
+        while len(buf) < n:
+            if deadline is not None:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return False
+                conn.settimeout(remaining)
+            else:
+                conn.settimeout(None)
+            try:
+                data = conn.recv(4096)
+            except socket.timeout:
+                return False
+            if not data:
+                raise ConnectionError('client closed')
+            buf.extend(data)
+        return True
+
+    def _reply(self, conn, data):
+        if self.latency:
+            time.sleep(self.latency)
+        conn.sendall(data)
+
+    def _handle(self, conn):
+        buf = bytearray()
+        try:
+            while not self._stop.is_set():
+                self._read(conn, buf, 1)
+                cmd = buf[0]
+                if cmd == ord('C'):
+                    del buf[:1]
+                    self._reply(conn, self._position_packet())
+                elif cmd == ord('M'):
+                    self._read(conn, buf, MOVE_BYTES)
+                    target = np.array(struct.unpack('<III', bytes(buf[1:MOVE_BYTES])), dtype='float64')
+                    del buf[:MOVE_BYTES]
+                    self._do_move(conn, buf, target)
+                elif cmd == ord('H'):
+                    del buf[:1]
+                    self._do_move(conn, buf, self.home)
+                elif cmd == ord('Y'):
+                    del buf[:1]
+                    self._do_move(conn, buf, self.work)
+                elif cmd == ord('I'):
+                    self._read(conn, buf, 2)
+                    drive = buf[1]
+                    del buf[:2]
+                    if drive in self.positions:
+                        self.drive = drive
+                    self._reply(conn, CR)
+                elif cmd == ord('N'):
+                    del buf[:1]
+                    self.positions[self.drive] = np.zeros(3)
+                    self._reply(conn, CR)
+                elif cmd == 3: # interrupt with nothing moving
+                    del buf[:1]
+                    self._reply(conn, CR)
+                else: # stray CR/LF or unknown byte
+                    del buf[:1]
+                    continue
+                self.commands += 1
+        except (ConnectionError, OSError):
+            return
+
+    def _position_packet(self):
+        p = np.rint(self.position()).astype('uint32')
+        return struct.pack('<BIII', self.drive, *p) + CR
+
+    def _do_move(self, conn, buf, target):
+        # moves are timed from the configured speed; only position reads and an interrupt are accepted while moving
+        start = self.positions[self.drive].copy()
+        duration = np.linalg.norm((target - start)*CF)/self.speed
+        t0 = time.perf_counter()
+        with self._lock:
+            self._move = (t0, start, target, max(duration, 1e-9))
+        interrupted = False
+        while True:
+            while buf[:1] == b'C':
+                del buf[:1]
+                if self.answer_during_move:
+                    self._reply(conn, self._position_packet())
+                self.commands += 1
+            i = buf.find(b'\x03')
+            if i >= 0:
+                del buf[i:i+1]
+                interrupted = True
+                break
+            if not self._read(conn, buf, len(buf) + 1, deadline=t0 + duration):
+                break # move finished
+        position = self.position()
+        with self._lock:
+            self.positions[self.drive] = np.rint(position) if interrupted else target.copy()
+            self._move = None
+        self._reply(conn, CR)
+        if interrupted:
+            self._reply(conn, CR) # answer to the interrupt itself
+
+
+if __name__ == '__main__':
+    from timeit import default_timer as timer
+    from sutter import Sutter_driver
+
+    with SutterSimulator(speed=1300, latency=.001) as sim:
+        p = Sutter_driver(port=sim.url, baudrate=128000, bytesize=8, stopbits=1, Ans=1)
+        n = 200
+        start = timer()
+        for i in range(n):
+            pos = p.CurrentPos()
+        print('CurrentPos round trip: {:.2f} ms'.format(1e3*(timer() - start)/n))
+        start = timer()
+        p.Move2Pos(pack_move(1000, 500, 200))
+        print('1.136 mm move at 1.3 mm/s: {:.3f} s (expected {:.3f} s)'.format(timer() - start, np.linalg.norm([1000, 500, 200])/1300))
+        print('position:', struct.unpack('<BIII', p.CurrentPos()[:13]))
+
+        # position stream at 500 Hz through a move back home
+        from sutter import Async_Sutter, decode_position, decode_positions
+        sutter = Async_Sutter(p)
+        log = sutter.StartStream(rate=500)
+        time.sleep(.1)
+        sutter.Move2Pos(0, 0, 0).result()
+        time.sleep(.1)
+        sutter.StopStream().result()
+        sutter.Close()
+        dt = np.diff(log.data()['t'])*1e3
+        print('stream: {} positions at {:.0f} Hz, interval {:.2f} +- {:.2f} ms (max {:.2f}), {} late polls'.format(
+            log.count, log.rate(), dt.mean(), dt.std(), dt.max(), log.late))
+
+        packets = b''.join(struct.pack('<BIII', 1, i, 2*i, 3*i) + CR for i in range(10000))
+        start = timer()
+        one_by_one = [decode_position(packets[i:i+14]) for i in range(0, len(packets), 14)]
+        t_loop = timer() - start
+        start = timer()
+        batch = decode_positions(packets)
+        t_batch = timer() - start
+        assert np.array_equal(batch, one_by_one)
+        print('decoding 10000 packets: one by one {:.1f} ms, batched {:.2f} ms'.format(1e3*t_loop, 1e3*t_batch))
+        del p
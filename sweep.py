@@ -0,0 +1,82 @@
+"""
+    Parallel parameter sweep for the cell detector.
+
+    Runs every combination of bilateral diameter, sigmaColor, sigmaSpace and
+    threshold quantile over one frame on a process pool. The frame is placed in
+    shared memory once, so workers read it without pickling a copy per task.
+    Each (diameter, sigmaColor, sigmaSpace) filter runs once and all threshold
+    quantiles are applied to its output.
+
+    Returns a table (structured array) of detection counts and timings, one row
+    per combination.
+"""
+import itertools
+from multiprocessing import Pool, shared_memory
+from timeit import default_timer as timer
+import cv2
+import numpy as np
+from detection import find_cells
+from threshold import quantile_level
+
+SWEEP_DTYPE = np.dtype([
+    ('diameter', 'i4'),
+    ('sigma_color', 'f8'),
+    ('sigma_space', 'f8'),
+    ('quantile', 'f8'),
+    ('cells', 'i4'),
+    ('filter_s', 'f8'), # bilateral filter time, shared by all quantiles of a filter setting
+    ('detect_s', 'f8'), # threshold + cell finding time for this quantile
+])
+
+_shm = None
+_frame = None
+
+
+def _attach(name, shape, dtype):
+    # runs once in every worker: map the shared frame instead of receiving a copy
+    global _shm, _frame
+    cv2.setNumThreads(1) # one process per core already
+    _shm = shared_memory.SharedMemory(name=name)
+    _frame = np.ndarray(shape, dtype=dtype, buffer=_shm.buf)
+
+
+def _run(args):
+    (diameter, sigma_color, sigma_space), thresholds, criteria = args
+    start = timer()
+    filtered = cv2.bilateralFilter(_frame, int(diameter), sigma_color, sigma_space)
+    filter_s = timer() - start
+    rows = list()
+    for quantile, threshold in thresholds:
+        start = timer()
+        ret, masked_image = cv2.threshold(filtered, threshold, 1, cv2.THRESH_BINARY)
+        cells, labels = find_cells(masked_image, **criteria)
+        rows.append((diameter, sigma_color, sigma_space, quantile, len(cells), filter_s, timer() - start))
+    return rows
+
+
+def sweep(image, diameters, sigma_colors, sigma_spaces, quantiles=(.97,), processes=None, **criteria):
+    # PURPOSE: detect cells in image for every parameter combination, in parallel.
+    # image is normalized to [0,1] float32 like the GUI does. Extra keyword arguments go to find_cells.
+    norm_image = (image/np.max(image)).astype('float32')
+    thresholds = [(q, float(t)/np.max(image)) for q, t in zip(quantiles, quantile_level(image, quantiles))]
+    settings = list(itertools.product(diameters, sigma_colors, sigma_spaces))
+    tasks = [(s, thresholds, criteria) for s in settings]
+
+    shm = shared_memory.SharedMemory(create=True, size=norm_image.nbytes)
+    try:
+        shared = np.ndarray(norm_image.shape, dtype=norm_image.dtype, buffer=shm.buf)
+        shared[:] = norm_image
+        with Pool(processes, initializer=_attach, initargs=(shm.name, norm_image.shape, norm_image.dtype)) as pool:
+            results = pool.map(_run, tasks, chunksize=1)
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+    return np.array([row for rows in results for row in rows], dtype=SWEEP_DTYPE)
+
+
+def print_table(table):
+    print('{:>5} {:>8} {:>8} {:>6} {:>6} {:>10} {:>10}'.format('diam', 'sColor', 'sSpace', 'quant', 'cells', 'filter[ms]', 'detect[ms]'))
+    for r in table:
+        print('{:>5} {:>8.3g} {:>8.3g} {:>6.3f} {:>6} {:>10.1f} {:>10.1f}'.format(
+            r['diameter'], r['sigma_color'], r['sigma_space'], r['quantile'], r['cells'], 1e3*r['filter_s'], 1e3*r['detect_s']))
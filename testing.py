@@ -5,6 +5,8 @@ import matplotlib.pyplot as plt
 import tifffile as tiff
 from os import listdir
 from os.path import isfile, join
+from detection import find_cells, draw_cells
+from threshold import quantile_level
 linewidth = 3
 import numpy as np
 # http://layer0.authentise.com/detecting-circular-shapes-using-contours.html
@@ -12,6 +14,7 @@ import numpy as np
 # file_list = [f for f in listdir(mypath) if isfile(join(mypath, f)) & f.endswith(".tif")]
 
 # for filename in file_list:
+# (to run detection over a whole folder or TIFF stack, use batch_detect.py)
 # Read image, normalize to [0,1], get size
 raw_image = np.array(Image.open("1.tif").convert('L'))
 norm_image = raw_image/np.max(raw_image)
@@ -27,32 +30,14 @@ row,col = norm_image.shape
 
 # filter to preserve edges, threshold above 97 percentile 'fluorescence', use 2.4% of size for filter size
 bilateral_filtered_image = cv2.bilateralFilter(norm_image.astype('float32'), int(.019*row), int(.019*row), int(.019*row))
-ret, masked_image = cv2.threshold(bilateral_filtered_image,np.quantile(norm_image,.97),1,cv2.THRESH_BINARY)
+ret, masked_image = cv2.threshold(bilateral_filtered_image,quantile_level(raw_image,.97)/np.max(raw_image),1,cv2.THRESH_BINARY) # histogram of the 8-bit frame, no sort
 
-# find contours from masked image  
-contours, hierarchy = cv2.findContours(masked_image.astype('uint8'),cv2.RETR_LIST,cv2.CHAIN_APPROX_NONE)
-# cv2.drawContours(raw_image, contours, -1, (255,255,255), 2)
-
-centroids = list()
-for cnt in contours:
-    (x,y),radius = cv2.minEnclosingCircle(cnt)
-    rect_area = cv2.minAreaRect(cnt)
-    box = np.int0(cv2.boxPoints(rect_area))
-    print(box)
-    cv2.drawContours(contour_image,[box],-1,(0,0,255),1)
-    # print('x = ',x)
-    # print('y = ',y)
-    # print('radius = ',radius)
-
-    # if contour size is between .05% and 1% of field of view, count as cell
-    # also check if min enclosing circle is significantly bigger than contourArea to measure roundness
-    if cv2.contourArea(cnt) < .01*row*col and cv2.contourArea(cnt) > .0005*row*col and cv2.contourArea(cnt) > (radius*radius*3.1415*.5):
-        # print("Cell Detected")
-        cv2.drawContours(contour_image, cnt, -1, (100,140,204), linewidth)
-        M = cv2.moments(cnt)
-        cx = int(M['m10']/M['m00'])
-        cy = int(M['m01']/M['m00'])
-        centroids.append([cx, cy])
+# measure all blobs in the masked image in one pass (see detection.py)
+# if blob size is between .05% and 1% of field of view, count as cell
+# also check if min enclosing circle is significantly bigger than the blob area to measure roundness
+cells, labels = find_cells(masked_image)
+draw_cells(contour_image, cells, labels, (100,140,204), linewidth, markers=False)
+centroids = np.rint(np.column_stack((cells['cx'], cells['cy']))).astype(int).tolist()
 # cv2.imshow('Contours', norm_image) 
 # cv2.waitKey(0) 
 # cv2.destroyAllWindows()
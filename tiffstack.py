@@ -0,0 +1,152 @@
+"""
+    TIFF stacks of any length with bounded memory.
+
+    TiffStack opens a multi-page TIFF (camera stacks, ImageJ hyperstacks) and
+    exposes its frames without loading the file:
+
+        with TiffStack('stack.tif') as stack:
+            stack.shape                 # (frames, height, width)
+            frame = stack[100]          # read-only view, no copy (uncompressed files)
+            for first, block in stack.chunks(64):
+                ...                     # block: (<= 64, height, width), frames first..first+len(block)-1
+
+    Uncompressed, contiguous stacks are memory-mapped with tifffile.memmap, so
+    frames and chunks are views into the file and the OS page cache does the
+    rest; the next chunk is touched on a background thread while the current
+    one is processed. Compressed stacks (zlib, LZW, ...) are decoded page by
+    page on a thread pool (the codecs release the GIL), one chunk at a time,
+    with the next `prefetch` chunks decoding while the current one is used.
+    Either way at most (prefetch + 1) chunks are in memory.
+
+    Run this file to benchmark chunked reading against tifffile.imread.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tifffile as tiff
+
+
+class TiffStack(object):
+    def __init__(self, path, chunk=64, workers=4, prefetch=1):
+        self.path = path
+        self.chunk = chunk
+        self.prefetch = prefetch
+        self._file = tiff.TiffFile(path)
+        series = self._file.series[0]
+        self.dtype = series.dtype
+        frame_shape = series.shape[-3:] if series.axes.endswith('S') else series.shape[-2:] # RGB(A) samples stay with the frame
+        count = int(np.prod(series.shape))//int(np.prod(frame_shape))
+        self.shape = (count,) + tuple(frame_shape)
+        try:
+            self._data = tiff.memmap(path, mode='r').reshape(self.shape)
+        except ValueError: # compressed, tiled or scattered pages
+            self._data = None
+            self._pages = list(series.pages) if len(series.pages) == count else list(self._file.pages)[:count]
+            self._file.filehandle.set_lock(True) # pages are read from several threads
+        self._pool = ThreadPoolExecutor(workers) # page decodes
+        self._ahead = ThreadPoolExecutor(prefetch + 1) # chunks read ahead; separate, they wait on page decodes
+
+    @property
+    def mapped(self):
+        # True when frames are views into the memory-mapped file
+        return self._data is not None
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        # PURPOSE: one frame (int) or several (slice, index array). A view for mapped stacks, else decoded.
+        if self.mapped:
+            return self._data[key]
+        if isinstance(key, (int, np.integer)):
+            return self._decode(range(len(self))[key])
+        indices = range(len(self))[key] if isinstance(key, slice) else np.asarray(key)
+        return self._decode_many(indices)
+
+    def _decode(self, index, out=None):
+        return self._pages[index].asarray(out=out, maxworkers=1)
+
+    def _decode_many(self, indices):
+        block = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        list(self._pool.map(lambda k: self._decode(indices[k], out=block[k]), range(len(indices))))
+        return block
+
+    def _touch(self, start, stop):
+        # read one value per 4 kB memory page so the frames are in the page cache before they are used
+        flat = self._data[start:stop].reshape(-1)
+        return int(flat[::max(1, 4096//self.dtype.itemsize)].sum())
+
+    def chunks(self, size=None, start=0, stop=None):
+        # PURPOSE: iterate (first frame, block of frames) over [start, stop), size frames per block
+        size = size or self.chunk
+        stop = len(self) if stop is None else min(stop, len(self))
+        starts = deque(range(start, stop, size))
+        pending = deque() # (first frame, future) of the chunks being read ahead
+        while starts or pending:
+            while starts and len(pending) < self.prefetch + 1:
+                s = starts.popleft()
+                if self.mapped:
+                    pending.append((s, self._ahead.submit(self._touch, s, min(s + size, stop))))
+                else:
+                    pending.append((s, self._ahead.submit(self._decode_many, range(s, min(s + size, stop)))))
+            s, future = pending.popleft()
+            yield s, self._data[s:min(s + size, stop)] if self.mapped else future.result()
+
+    def close(self):
+        self._ahead.shutdown(wait=True)
+        self._pool.shutdown(wait=True)
+        self._data = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+    from timeit import default_timer as timer
+
+    folder = tempfile.mkdtemp()
+    rng = np.random.default_rng(0)
+    frames, shape = 300, (1024, 1280)
+    data = rng.integers(0, 4096, (frames,) + shape).astype('uint16')
+    data[:, ::2] = data[:, :1] # some redundancy for the codecs
+    plain = os.path.join(folder, 'plain.tif')
+    packed = os.path.join(folder, 'zlib.tif')
+    tiff.imwrite(plain, data)
+    tiff.imwrite(packed, data, compression='zlib', compressionargs={'level': 1})
+    print('{} frames of {}x{} uint16: {:.0f} MB uncompressed, {:.0f} MB zlib'.format(
+        frames, shape[1], shape[0], os.path.getsize(plain)/1e6, os.path.getsize(packed)/1e6))
+
+    for path in (plain, packed):
+        start = timer()
+        whole = tiff.imread(path)
+        t_imread = timer() - start
+        start = timer()
+        with TiffStack(path) as stack:
+            t_open = timer() - start
+            total = 0
+            for first, block in stack.chunks(32):
+                total += int(block[:, 512, 640].sum()) # stand-in for per-chunk processing
+                assert np.array_equal(block[-1], data[first + len(block) - 1])
+            mapped = stack.mapped
+        t_chunks = timer() - start
+        print('{:5s} mapped={}: open {:.1f} ms, chunks {:.0f} ms ({:.2f} ms/frame, <= 2 chunks of 32 in memory);'
+              ' tifffile.imread {:.0f} ms for a {:.0f} MB copy'.format(
+              os.path.basename(path), mapped, 1e3*t_open, 1e3*t_chunks, 1e3*t_chunks/frames, 1e3*t_imread, whole.nbytes/1e6))
+        del whole
+
+    # a chunk decode waits on page decodes: any number of workers must get through a compressed stack
+    for workers in (1, 2):
+        with TiffStack(packed, workers=workers, prefetch=2) as stack:
+            for first, block in stack.chunks(4, stop=40):
+                assert np.array_equal(block, data[first:first + len(block)])
+    print('zlib chunks with 1 and 2 decode workers: ok')
@@ -0,0 +1,198 @@
+"""
+    Stable IDs for detected cells across frames.
+
+    CellTracker links the centroids of each new frame (idFluorescentCells,
+    YOLO boxes in liveImaging_um.py) to the tracks of the previous ones:
+
+        tracker = CellTracker(max_distance=15)
+        ids = tracker.update(centroids)     # (n, 2) x, y -> one ID per centroid
+        tracker.history()                   # TRACK_DTYPE rows (frame, id, x, y)
+        tracker.positions()                 # (frames, tracks, 2), nan where a track was not seen
+
+    Only pairs closer than max_distance are candidates. They are found with a
+    KD-tree (scipy.spatial.cKDTree.sparse_distance_matrix), so the cost matrix
+    is sparse. The matching is solved per connected component of that sparse
+    graph: a lone track-detection pair is taken as is, the few contested
+    groups go through the Hungarian algorithm (linear_sum_assignment) on their
+    own small matrix. Tracks are looked for at their last position plus the
+    median move per frame of the tracks matched in the previous frame, so a common drift of the
+    field does not eat into max_distance. A track that is not matched for more than max_missed
+    frames is retired; a detection without a track starts a new one.
+
+    Run this file to benchmark against a dense assignment over all pairs.
+"""
+import cv2
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+TRACK_DTYPE = np.dtype([('frame', 'i4'), ('id', 'i4'), ('x', 'f4'), ('y', 'f4')])
+
+
+def match(a, b, max_distance):
+    # PURPOSE: (rows, cols) of a one-to-one matching of points a (n, 2) to b (m, 2), only pairs closer than
+    # max_distance. Maximizes the number of pairs, then minimizes their total distance.
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    pairs = cKDTree(a).sparse_distance_matrix(cKDTree(b), max_distance, output_type='coo_matrix')
+    rows, cols, dist = pairs.row, pairs.col, pairs.data
+    if len(rows) == 0:
+        return rows, cols
+    n, m = len(a), len(b)
+    # components of the bipartite graph: nodes 0..n-1 are rows, n..n+m-1 are cols
+    graph = coo_matrix((np.ones(len(rows)), (rows, n + cols)), shape=(n + m, n + m))
+    count, component = connected_components(graph, directed=False)
+    edges = np.bincount(component[rows], minlength=count)
+    nodes = np.bincount(component, minlength=count)
+    lone = (edges[component[rows]] == 1) & (nodes[component[rows]] == 2) # one track, one detection, one edge
+    matched_rows, matched_cols = [rows[lone]], [cols[lone]]
+    contested = ~lone
+    if contested.any():
+        order = np.argsort(component[rows[contested]], kind='stable')
+        r, c, d = rows[contested][order], cols[contested][order], dist[contested][order]
+        groups = np.split(np.arange(len(r)), np.flatnonzero(np.diff(component[r]))+1)
+        big = 2*max_distance*(len(a) + len(b)) # any real pair beats leaving one out
+        for g in groups:
+            ur, ir = np.unique(r[g], return_inverse=True)
+            uc, ic = np.unique(c[g], return_inverse=True)
+            cost = np.full((len(ur), len(uc)), big)
+            cost[ir, ic] = d[g]
+            i, j = linear_sum_assignment(cost)
+            real = cost[i, j] < big
+            matched_rows.append(ur[i[real]])
+            matched_cols.append(uc[j[real]])
+    return np.concatenate(matched_rows), np.concatenate(matched_cols)
+
+
+class CellTracker(object):
+    def __init__(self, max_distance=15., max_missed=5, capacity=1 << 16):
+        # max_distance: largest move between frames [px]; max_missed: frames a track may go undetected
+        self.max_distance = max_distance
+        self.max_missed = max_missed
+        self.frame = 0 # frames seen
+        self.next_id = 0
+        self.drift = np.zeros(2) # median move of the matched tracks in the last frame (stage or slice drift)
+        self._ids = np.zeros(0, dtype='int32') # active tracks
+        self._xy = np.zeros((0, 2))
+        self._missed = np.zeros(0, dtype='int32')
+        self._history = np.zeros(capacity, dtype=TRACK_DTYPE)
+        self._rows = 0
+
+    def update(self, points):
+        # PURPOSE: IDs (int32) for the (n, 2) x, y points of the next frame
+        points = np.asarray(points, dtype='float64').reshape(-1, 2)
+        frames = self._missed[:, None] + 1. # since each track was last seen
+        rows, cols = match(self._xy + frames*self.drift, points, self.max_distance)
+        if len(rows):
+            self.drift = np.median((points[cols] - self._xy[rows])/frames[rows], axis=0)
+        ids = np.full(len(points), -1, dtype='int32')
+        ids[cols] = self._ids[rows]
+        new = ids < 0
+        ids[new] = self.next_id + np.arange(new.sum(), dtype='int32')
+        self.next_id += int(new.sum())
+
+        missed = self._missed + 1
+        missed[rows] = 0
+        self._xy[rows] = points[cols]
+        alive = missed <= self.max_missed
+        self._ids = np.concatenate([self._ids[alive], ids[new]])
+        self._xy = np.concatenate([self._xy[alive], points[new]])
+        self._missed = np.concatenate([missed[alive], np.zeros(new.sum(), dtype='int32')])
+
+        self._append(ids, points)
+        self.frame += 1
+        return ids
+
+    def _append(self, ids, points):
+        end = self._rows + len(ids)
+        if end > len(self._history):
+            grown = np.zeros(max(end, 2*len(self._history)), dtype=TRACK_DTYPE)
+            grown[:self._rows] = self._history[:self._rows]
+            self._history = grown
+        rows = self._history[self._rows:end]
+        rows['frame'] = self.frame
+        rows['id'] = ids
+        rows['x'] = points[:, 0]
+        rows['y'] = points[:, 1]
+        self._rows = end
+
+    def active(self):
+        # PURPOSE: (ids, xy) of the tracks still followed
+        return self._ids.copy(), self._xy.copy()
+
+    def history(self):
+        # PURPOSE: TRACK_DTYPE row for every detection so far, in frame order
+        return self._history[:self._rows].copy()
+
+    def track(self, id):
+        # PURPOSE: rows of one track
+        h = self._history[:self._rows]
+        return h[h['id'] == id]
+
+    def positions(self):
+        # PURPOSE: (frames, tracks, 2) x, y of every track in every frame, nan where it was not detected
+        h = self._history[:self._rows]
+        xy = np.full((self.frame, self.next_id, 2), np.nan, dtype='float32')
+        xy[h['frame'], h['id'], 0] = h['x']
+        xy[h['frame'], h['id'], 1] = h['y']
+        return xy
+
+
+def draw_ids(image, points, ids, color=200, scale=.4):
+    # PURPOSE: write each track ID next to its point, in place
+    for (x, y), id in zip(np.rint(points).astype(int), ids):
+        cv2.putText(image, str(id), (int(x) + 6, int(y) - 6), cv2.FONT_HERSHEY_SIMPLEX, scale, color, 1, cv2.LINE_AA)
+    return image
+
+
+if __name__ == '__main__':
+    from timeit import default_timer as timer
+
+    # cells drifting in a 1280x1024 field, detections jittered, some missed, some appearing and disappearing
+    rng = np.random.default_rng(0)
+    for n_cells in (100, 300, 500):
+        frames = 200
+        xy = rng.uniform(0, (1280, 1024), (4*n_cells, 2))
+        d, i = cKDTree(xy).query(xy, 2)
+        xy = xy[d[:, 1] > 15][:n_cells] # somata do not overlap
+        n_cells = len(xy)
+        true_id = np.arange(n_cells)
+        tracker = CellTracker(max_distance=8.)
+        detections = []
+        for f in range(frames):
+            xy += rng.normal(0, .3, xy.shape) + (1., .5) # stage drift plus some movement of each cell
+            seen = rng.random(n_cells) > .03
+            replaced = rng.random(n_cells) < .002 # a cell leaves, another one appears elsewhere
+            new = rng.uniform(0, (1280, 1024), (replaced.sum(), 2))
+            clear = cKDTree(xy).query(new)[0] > 15 # not on top of another cell
+            replaced[np.flatnonzero(replaced)[~clear]] = False
+            xy[replaced] = new[clear]
+            true_id[replaced] = true_id.max() + 1 + np.arange(replaced.sum())
+            order = rng.permutation(np.flatnonzero(seen))
+            detections.append((xy[order] + rng.normal(0, .5, (len(order), 2)), true_id[order]))
+
+        start = timer()
+        for points, truth in detections:
+            tracker.update(points)
+        t_sparse = 1e3*(timer() - start)/frames
+        # identity errors: detections whose tracker ID maps to a different true cell than most of that ID's detections
+        h = tracker.history()
+        truth = np.concatenate([t for p, t in detections])
+        pair, count = np.unique(np.column_stack([h['id'], truth]), axis=0, return_counts=True)
+        majority = np.zeros(tracker.next_id, dtype=int)
+        np.maximum.at(majority, pair[:, 0], count)
+        switches = len(h) - majority.sum()
+
+        # dense reference: full distance matrix + Hungarian over all pairs, a few frames
+        a, b = detections[0][0], detections[1][0]
+        start = timer()
+        for i in range(3):
+            d = np.hypot(a[:, None, 0] - b[None, :, 0], a[:, None, 1] - b[None, :, 1])
+            d[d > 8.] = 1e6
+            linear_sum_assignment(d)
+        t_dense = 1e3*(timer() - start)/3
+        print('{:5d} cells: sparse {:6.2f} ms/frame, dense Hungarian {:8.1f} ms/frame; {} tracks for {} cells, '
+              '{:.3%} of detections on another cell\'s track'.format(
+              n_cells, t_sparse, t_dense, tracker.next_id, true_id.max() + 1, switches/len(h)))
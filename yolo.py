@@ -11,18 +11,227 @@ ECE 6258: Digital Image Processing
 import colorsys
 import os
 from timeit import default_timer as timer
+import cv2
 import numpy as np
 import tensorflow as tf
 import keras.backend as K
 from keras.models import load_model
 from keras.layers import Input
-from PIL import Image, ImageFont, ImageDraw
+from PIL import Image
 from yolo3.model import yolo_eval, yolo_body, tiny_yolo_body
-from yolo3.utils import letterbox_image
 import os
 from tensorflow.keras.utils import multi_gpu_model
 from skimage import color
 
+def letterbox(frame, size):
+    # PURPOSE: yolo3.utils.letterbox_image for a PIL image or an array: PIL bicubic resize (antialiased, same model
+    # input as before) keeping the aspect ratio, padded with gray. Returns an (h, w, 3) RGB uint8 array.
+    image = frame if isinstance(frame, Image.Image) else Image.fromarray(np.asarray(frame))
+    w, h = size
+    iw, ih = image.size
+    scale = min(w/iw, h/ih)
+    nw = int(iw*scale)
+    nh = int(ih*scale)
+    boxed = Image.new('RGB', size, (128, 128, 128))
+    boxed.paste(image.resize((nw, nh), Image.BICUBIC), ((w - nw)//2, (h - nh)//2))
+    return np.asarray(boxed)
+
+def _sigmoid(x):
+    return 1./(1. + np.exp(-x))
+
+def nms(boxes, scores, iou_threshold, max_boxes=None, tiles=None, tile_boxes=None):
+    # PURPOSE: greedy non-max suppression on (top, left, bottom, right) boxes. Returns kept indices, best first.
+    # Each step suppresses every remaining box that overlaps the current best one, using array ops.
+    # tiles (tile index of each box) and tile_boxes (top, left, bottom, right of each tile) are for merge_tiles:
+    # two boxes from different tiles that meet inside the overlap of their tiles are compared by intersection
+    # over the smaller box, so a box cut by a tile border is suppressed by the whole box of the same cell from
+    # the neighbouring tile. Boxes from the same tile are compared by IoU only.
+    order = np.argsort(-scores, kind='stable')
+    boxes = boxes[order]
+    if tiles is not None:
+        tiles = tiles[order]
+    area = (boxes[:, 2] - boxes[:, 0])*(boxes[:, 3] - boxes[:, 1])
+    alive = np.ones(len(order), dtype=bool)
+    keep = list()
+    for i in range(len(order)):
+        if not alive[i]:
+            continue
+        keep.append(order[i])
+        if max_boxes is not None and len(keep) == max_boxes:
+            break
+        rest = i + 1 + np.flatnonzero(alive[i+1:])
+        top = np.maximum(boxes[i, 0], boxes[rest, 0])
+        left = np.maximum(boxes[i, 1], boxes[rest, 1])
+        bottom = np.minimum(boxes[i, 2], boxes[rest, 2])
+        right = np.minimum(boxes[i, 3], boxes[rest, 3])
+        inter = np.maximum(bottom - top, 0)*np.maximum(right - left, 0)
+        iou = inter/(area[i] + area[rest] - inter + 1e-12)
+        if tiles is not None:
+            a, b = tile_boxes[tiles[i]], tile_boxes[tiles[rest]]
+            # the intersection of the two boxes reaches into the overlap of the two tiles
+            shared = (tiles[rest] != tiles[i]) & (inter > 0) & \
+                     (top < np.minimum(a[2], b[:, 2])) & (bottom > np.maximum(a[0], b[:, 0])) & \
+                     (left < np.minimum(a[3], b[:, 3])) & (right > np.maximum(a[1], b[:, 1]))
+            ios = inter/(np.minimum(area[i], area[rest]) + 1e-12)
+            iou = np.where(shared, np.maximum(iou, ios), iou)
+        alive[rest[iou > iou_threshold]] = False
+    return np.array(keep, dtype='int64')
+
+def decode_outputs(outputs, anchors, num_classes, input_shape, image_shapes, score_threshold, iou_threshold, max_boxes=20):
+    # PURPOSE: NumPy version of yolo3.model.yolo_eval for a whole batch of raw model outputs.
+    # input_shape is the letterboxed (height, width); image_shapes holds the original (height, width) of every frame.
+    # Returns one (boxes, scores, classes) per frame; boxes are (top, left, bottom, right) in frame pixels.
+    num_layers = len(outputs)
+    anchor_mask = [[6,7,8], [3,4,5], [0,1,2]] if num_layers==3 else [[3,4,5], [1,2,3]]
+    input_h, input_w = input_shape
+    batch = outputs[0].shape[0]
+    yxhw = list()
+    box_scores = list()
+    for l in range(num_layers):
+        a = anchors[anchor_mask[l]]
+        gh, gw = outputs[l].shape[1:3]
+        feats = outputs[l].reshape(batch, gh, gw, len(a), num_classes + 5)
+        x = (_sigmoid(feats[..., 0]) + np.arange(gw).reshape(1, 1, gw, 1))/gw
+        y = (_sigmoid(feats[..., 1]) + np.arange(gh).reshape(1, gh, 1, 1))/gh
+        w = np.exp(feats[..., 2])*a[:, 0]/input_w
+        h = np.exp(feats[..., 3])*a[:, 1]/input_h
+        yxhw.append(np.stack([y, x, h, w], axis=-1).reshape(batch, -1, 4))
+        box_scores.append((_sigmoid(feats[..., 4:5])*_sigmoid(feats[..., 5:])).reshape(batch, -1, num_classes))
+    yxhw = np.concatenate(yxhw, axis=1)
+    box_scores = np.concatenate(box_scores, axis=1)
+
+    results = list()
+    for b in range(batch):
+        ih, iw = image_shapes[b]
+        idx, cls = np.nonzero(box_scores[b] >= score_threshold)
+        scores = box_scores[b, idx, cls]
+        # undo the letterbox (yolo_correct_boxes)
+        scale = min(input_h/ih, input_w/iw)
+        new_h = np.round(ih*scale)
+        new_w = np.round(iw*scale)
+        y = (yxhw[b, idx, 0] - (input_h - new_h)/2./input_h)*input_h/new_h
+        x = (yxhw[b, idx, 1] - (input_w - new_w)/2./input_w)*input_w/new_w
+        h = yxhw[b, idx, 2]*input_h/new_h
+        w = yxhw[b, idx, 3]*input_w/new_w
+        boxes = np.stack([(y - h/2.)*ih, (x - w/2.)*iw, (y + h/2.)*ih, (x + w/2.)*iw], axis=-1)
+        keep = list()
+        for c in np.unique(cls): # NMS per class, like yolo_eval
+            members = np.flatnonzero(cls == c)
+            keep.append(members[nms(boxes[members], scores[members], iou_threshold, max_boxes)])
+        keep = np.concatenate(keep) if keep else np.zeros(0, dtype='int64')
+        results.append((boxes[keep].astype('float32'), scores[keep].astype('float32'), cls[keep].astype('int32')))
+    return results
+
+def tile_origins(length, tile, overlap, count=None):
+    # PURPOSE: start of every tile along one axis, evenly spread so the tiles cover [0, length) and neighbours
+    # overlap by at least overlap pixels. count=None uses as few tiles as possible.
+    if count is None:
+        count = max(1, int(np.ceil((length - overlap)/(tile - overlap))))
+    if count == 1 or tile >= length:
+        return np.zeros(1, dtype='int64')
+    return np.rint(np.arange(count)*(length - tile)/(count - 1)).astype('int64')
+
+def tile_frame(shape, tile_size, overlap=64, grid=None):
+    # PURPOSE: (tops, lefts, tile height, tile width) cutting a (height, width) frame into overlapping tiles.
+    # grid=None: tiles of tile_size (the model input, full resolution). grid=(rows, cols): that many tiles,
+    # each as large as needed to cover the frame (letterboxed down to the model input if larger).
+    h, w = shape[:2]
+    if grid is None:
+        th, tw = min(tile_size[0], h), min(tile_size[1], w)
+        rows, cols = None, None
+    else:
+        rows, cols = grid
+        th = min(h, int(np.ceil((h + (rows - 1)*overlap)/rows)))
+        tw = min(w, int(np.ceil((w + (cols - 1)*overlap)/cols)))
+    tops, lefts = tile_origins(h, th, overlap, rows), tile_origins(w, tw, overlap, cols)
+    return np.repeat(tops, len(lefts)), np.tile(lefts, len(tops)), th, tw
+
+def merge_tiles(results, tops, lefts, tile_shape, frame_shape, iou_threshold, max_boxes=None):
+    # PURPOSE: one (boxes, scores, classes) for the frame from per-tile detections.
+    # Boxes move to frame coordinates. A box that touches a border shared with another tile and ends inside the
+    # overlap is dropped: the neighbouring tile holds the whole cell. The rest are merged per class by NMS, with
+    # intersection over the smaller box for pairs from different tiles that meet in an overlap, which removes
+    # the duplicates from the overlaps; boxes of one tile keep the IoU NMS of detect_image.
+    th, tw = tile_shape
+    h, w = frame_shape[:2]
+    tile_boxes = np.column_stack([tops, lefts, tops + th, lefts + tw]).astype('float64')
+    all_boxes, all_scores, all_classes, all_tiles = list(), list(), list(), list()
+    for k, ((boxes, scores, classes), top, left) in enumerate(zip(results, tops, lefts)):
+        boxes = boxes + np.array([top, left, top, left], dtype=boxes.dtype)
+        edge = 2. # px
+        # borders shared with a neighbour, and how far into this tile the neighbour reaches
+        up = top > 0
+        down = top + th < h
+        lt = left > 0
+        rt = left + tw < w
+        reach_up = tops[(tops < top) & (tops + th > top)].max(initial=top) + th if up else top
+        reach_down = tops[(tops > top) & (tops < top + th)].min(initial=top + th) if down else top + th
+        reach_lt = lefts[(lefts < left) & (lefts + tw > left)].max(initial=left) + tw if lt else left
+        reach_rt = lefts[(lefts > left) & (lefts < left + tw)].min(initial=left + tw) if rt else left + tw
+        cut = (up & (boxes[:, 0] <= top + edge) & (boxes[:, 2] <= reach_up)) | \
+              (down & (boxes[:, 2] >= top + th - edge) & (boxes[:, 0] >= reach_down)) | \
+              (lt & (boxes[:, 1] <= left + edge) & (boxes[:, 3] <= reach_lt)) | \
+              (rt & (boxes[:, 3] >= left + tw - edge) & (boxes[:, 1] >= reach_rt))
+        all_boxes.append(boxes[~cut])
+        all_scores.append(scores[~cut])
+        all_classes.append(classes[~cut])
+        all_tiles.append(np.full(np.count_nonzero(~cut), k))
+    boxes = np.concatenate(all_boxes)
+    scores = np.concatenate(all_scores)
+    classes = np.concatenate(all_classes)
+    tiles = np.concatenate(all_tiles)
+    keep = list()
+    for c in np.unique(classes):
+        members = np.flatnonzero(classes == c)
+        keep.append(members[nms(boxes[members], scores[members], iou_threshold, max_boxes, tiles[members], tile_boxes)])
+    keep = np.concatenate(keep) if keep else np.zeros(0, dtype='int64')
+    return boxes[keep], scores[keep], classes[keep]
+
+class BoxRenderer(object):
+    # Draws labelled detection boxes onto frames with OpenCV: all outlines in one polylines call and all
+    # label backgrounds in one fillPoly call. Font metrics are cached per font size.
+    def __init__(self, class_names, box_color=(255, 0, 0), text_color=(0, 0, 0), font_face=cv2.FONT_HERSHEY_SIMPLEX):
+        self.class_names = class_names
+        self.box_color = box_color
+        self.text_color = text_color
+        self.font_face = font_face
+        self._fonts = dict() # font height [px] -> (scale, stroke)
+
+    def font(self, size):
+        if size not in self._fonts:
+            self._fonts[size] = (cv2.getFontScaleFromHeight(self.font_face, int(size)), max(1, int(size)//12))
+        return self._fonts[size]
+
+    def draw(self, frame, boxes, scores, classes):
+        # PURPOSE: return an RGB copy of frame with every box drawn. Sizes follow the old PIL drawing:
+        # font height 3% of the image height, line thickness (width + height)/300.
+        image = cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB) if frame.ndim == 2 else np.array(frame[..., :3])
+        if len(boxes) == 0:
+            return image
+        h, w = image.shape[:2]
+        scale, stroke = self.font(np.floor(3e-2*h + 0.5))
+        thickness = max(1, (w + h)//300)
+
+        tlbr = np.floor(np.asarray(boxes) + 0.5).astype('int32')
+        top = np.maximum(0, tlbr[:, 0])
+        left = np.maximum(0, tlbr[:, 1])
+        bottom = np.minimum(h, tlbr[:, 2])
+        right = np.minimum(w, tlbr[:, 3])
+        outlines = np.stack([left, top, right, top, right, bottom, left, bottom], axis=1).reshape(-1, 4, 2)
+        cv2.polylines(image, list(outlines), True, self.box_color, thickness)
+
+        labels = ['{} {:.2f}'.format(self.class_names[c], s) for c, s in zip(classes, scores)]
+        sizes = np.array([cv2.getTextSize(label, self.font_face, scale, stroke)[0] for label in labels]).reshape(-1, 2)
+        label_h = sizes[:, 1] + stroke + 2
+        label_top = np.where(top - label_h >= 0, top - label_h, top + 1)
+        label_right = left + sizes[:, 0] + 2
+        backgrounds = np.stack([left, label_top, label_right, label_top, label_right, label_top + label_h,
+                                left, label_top + label_h], axis=1).reshape(-1, 4, 2)
+        cv2.fillPoly(image, list(backgrounds), self.box_color)
+        for label, x, y in zip(labels, left, label_top + sizes[:, 1] + 1):
+            cv2.putText(image, label, (int(x) + 1, int(y)), self.font_face, scale, self.text_color, stroke, cv2.LINE_AA)
+        return image
+
 class YOLO(object):
     _defaults = {
         # For Chris:
@@ -47,6 +256,7 @@ class YOLO(object):
         self.anchors = self._get_anchors()
         self.sess = K.get_session() # MG
         self.boxes, self.scores, self.classes = self.generate()
+        self.renderer = BoxRenderer(self.class_names)
     def _get_class(self):
         classes_path = os.path.expanduser(self.classes_path)
         with open(classes_path) as f:
@@ -96,82 +306,111 @@ class YOLO(object):
                 score_threshold=self.score, iou_threshold=self.iou)
         return boxes, scores, classes
 
-    def detect_image(self, image):
-    # def detect_image(self, image, logPath, timeLog):
-        start = timer()
-        # logFileObj = open(logPath,mode='w+')
+    def preprocess(self, image):
+        # PURPOSE: letterbox a PIL image or (H, W[, 3]) array into a (1, h, w, 3) float32 model input
+        frame = np.asarray(image)
+        h, w = frame.shape[:2]
         if self.model_image_size != (None, None):
             assert self.model_image_size[0]%32 == 0, 'Multiples of 32 required'
             assert self.model_image_size[1]%32 == 0, 'Multiples of 32 required'
-            boxed_image = letterbox_image(image, tuple(reversed(self.model_image_size)))
+            boxed_size = tuple(reversed(self.model_image_size))
         else:
-            new_image_size = (image.width - (image.width % 32),
-                              image.height - (image.height % 32))
-            boxed_image = letterbox_image(image, new_image_size)
-        image_data = np.array(boxed_image, dtype='float32')
-        image = image.convert("RGB")
-        # print(image_data.shape)
+            boxed_size = (w - (w % 32), h - (h % 32))
+        image_data = np.expand_dims(letterbox(frame, boxed_size), 0).astype('float32')  # Add batch dimension.
         image_data /= 255.
-        image_data = np.expand_dims(image_data, 0)  # Add batch dimension.
-        out_boxes, out_scores, out_classes = self.sess.run(
+        return image_data
+
+    def infer(self, image_data, image_shape):
+        # PURPOSE: run the graph on a preprocessed frame. image_shape is the original (height, width).
+        return self.sess.run(
             [self.boxes, self.scores, self.classes],
             feed_dict={
                 self.yolo_model.input: image_data,
-                self.input_image_shape: [image.size[1], image.size[0]],
+                self.input_image_shape: list(image_shape),
                 K.learning_phase(): 0
             })
 
-        # print('Found {} boxes for {}'.format(len(out_boxes), 'img'),file=logFileObj)
-        # print('Found {} boxes for {}'.format(len(out_boxes), 'img'))#,file=logFileObj)
-
-        # font = ImageFont.truetype(font='C:/Users/mgonzalez91/AND_repo/AND_Project-1/AND_yolo3/font/FiraMono-Medium.otf',
-        font = ImageFont.truetype(font='font/FiraMono-Medium.otf',
-                    size=np.floor(3e-2 * image.size[1] + 0.5).astype('int32'))
-        thickness = (image.size[0] + image.size[1]) // 300
-
-        for i, c in reversed(list(enumerate(out_classes))):
-            predicted_class = self.class_names[c]
-            box = out_boxes[i]
-            score = out_scores[i]
-            label = '{} {:.2f}'.format(predicted_class, score)
-            draw = ImageDraw.Draw(image)
-            label_size = draw.textsize(label, font)
-            top, left, bottom, right = box
-            top = max(0, np.floor(top + 0.5).astype('int32'))
-            left = max(0, np.floor(left + 0.5).astype('int32'))
-            bottom = min(image.size[1], np.floor(bottom + 0.5).astype('int32'))
-            right = min(image.size[0], np.floor(right + 0.5).astype('int32'))
-            # print(label, (left, top), (right, bottom),file=logFileObj)
-            # print(label, left, top, right, bottom, file=logFileObj)
-
-            if top - label_size[1] >= 0:
-                text_origin = np.array([left, top - label_size[1]])
-            else:
-                text_origin = np.array([left, top + 1])
-            # My kingdom for a good redistributable image drawing library.
-            for i in range(thickness):
-                draw.rectangle(
-                    [left + i, top + i, right - i, bottom - i],
-                    outline="red")
-            draw.rectangle(
-                [tuple(text_origin), tuple(text_origin + label_size)],
-                fill="red")
-            draw.text(text_origin, label, fill=(0), font=font)
-            del draw
-
-        end = timer()
-        # print('Time to guess (s):',end - start,file=logFileObj)
-        # logFileTime = open(timeLog, mode='a')
-        # print(end - start, file=logFileTime)
-        # logFileTime.close()
-        # logFileObj.close()
-        return image
+    def detect(self, image):
+        # PURPOSE: detection only, no drawing. image is a PIL image or an (H, W[, 3]) array.
+        # Returns (boxes, scores, classes) arrays, boxes as (top, left, bottom, right) in image pixels.
+        frame = np.asarray(image)
+        return self.infer(self.preprocess(frame), frame.shape[:2])
+
+    def detect_image(self, image):
+        # PURPOSE: detect and draw the labelled boxes. Returns an annotated RGB PIL image.
+        out_boxes, out_scores, out_classes = self.detect(image)
+        return Image.fromarray(self.renderer.draw(np.asarray(image), out_boxes, out_scores, out_classes))
+
+    def detect_batch(self, frames, batch_size=8):
+        # PURPOSE: detect objects in many frames, batch_size frames per sess.run.
+        # frames: list of PIL images / arrays, or an (N, H, W[, 3]) array. Frames may differ in size.
+        # Returns one (boxes, scores, classes) tuple of arrays per frame, boxes as (top, left, bottom, right).
+        assert self.model_image_size != (None, None), 'detect_batch needs a fixed model_image_size'
+        assert self.model_image_size[0]%32 == 0, 'Multiples of 32 required'
+        assert self.model_image_size[1]%32 == 0, 'Multiples of 32 required'
+        input_h, input_w = self.model_image_size
+        batch = np.empty((batch_size, input_h, input_w, 3), dtype='float32') # reused for every batch
+        results = list()
+        for start in range(0, len(frames), batch_size):
+            chunk = [np.asarray(f) for f in frames[start:start+batch_size]]
+            for i, frame in enumerate(chunk):
+                np.multiply(letterbox(frame, (input_w, input_h)), 1./255., out=batch[i])
+            outputs = self.sess.run(self.yolo_model.output, feed_dict={
+                self.yolo_model.input: batch[:len(chunk)],
+                K.learning_phase(): 0
+            })
+            if not isinstance(outputs, list):
+                outputs = [outputs]
+            results.extend(decode_outputs(outputs, self.anchors, len(self.class_names), (input_h, input_w),
+                                          [f.shape[:2] for f in chunk], self.score, self.iou))
+        return results
+
+    def detect_tiled(self, image, grid=None, overlap=64, batch_size=16):
+        # PURPOSE: detection on overlapping tiles of the full-resolution frame instead of one downscaled frame,
+        # so small somata keep their size in pixels. grid=None: model-sized tiles at full resolution (best recall,
+        # 12 tiles for 1280x1024 at 416x416); grid=(rows, cols): fewer, larger tiles, each scaled down to the
+        # model input (lower latency). All tiles go through sess.run in batches of batch_size.
+        # Returns (boxes, scores, classes) like detect, boxes as (top, left, bottom, right) in frame pixels.
+        assert self.model_image_size != (None, None), 'detect_tiled needs a fixed model_image_size'
+        frame = np.asarray(image)
+        input_h, input_w = self.model_image_size
+        tops, lefts, th, tw = tile_frame(frame.shape, (input_h, input_w), overlap, grid)
+        tiles = [frame[t:t+th, l:l+tw] for t, l in zip(tops, lefts)]
+        results = self.detect_batch(tiles, batch_size=min(batch_size, len(tiles)))
+        return merge_tiles(results, tops, lefts, (th, tw), frame.shape, self.iou)
 
     def close_session(self):
         self.sess.close()
 
-def detect_video(yolo, video_path, output_path=""):
-    import cv2
+_END = None # marks the end of the stream in the pipeline queues
+
+def _stage(name, work, q_in, q_out, latency, failed):
+    # one pipeline stage: apply work to every item of q_in, pass the result to q_out, time each item
+    try:
+        while True:
+            item = q_in.get()
+            if item is _END:
+                break
+            start = timer()
+            result = work(item)
+            latency[name].append(timer() - start)
+            if q_out is not None:
+                q_out.put(result)
+    except Exception as e:
+        failed.append((name, e))
+        while q_in.get() is not _END: # keep upstream stages from blocking
+            pass
+    if q_out is not None:
+        q_out.put(_END)
+
+def detect_video(yolo, video_path, output_path="", headless=False, queue_size=8):
+    # PURPOSE: run the detector over a video (or webcam index) and optionally write the annotated video.
+    # Decode, preprocess, inference and annotate/encode run on their own threads with bounded queues between
+    # them, so the total rate is set by the slowest stage instead of the sum of all of them.
+    # headless=True skips the preview window. Press q in the window to stop early.
+    # Returns per-stage latency statistics.
+    import queue
+    import threading
     vid = cv2.VideoCapture(video_path)
     if not vid.isOpened():
         raise IOError("Couldn't open webcam or video")
@@ -180,33 +419,110 @@ def detect_video(yolo, video_path, output_path=""):
     video_size      = (int(vid.get(cv2.CAP_PROP_FRAME_WIDTH)),
                         int(vid.get(cv2.CAP_PROP_FRAME_HEIGHT)))
     isOutput = True if output_path != "" else False
-    if isOutput:
-        print("!!! TYPE:", type(output_path), type(video_FourCC), type(video_fps), type(video_size))
-        out = cv2.VideoWriter(output_path, video_FourCC, video_fps, video_size)
-    accum_time = 0
-    curr_fps = 0
-    fps = "FPS: ??"
-    prev_time = timer()
-    while True:
-        return_value, frame = vid.read()
-        image = Image.fromarray(frame)
-        image = yolo.detect_image(image)
-        result = np.asarray(image)
-        curr_time = timer()
-        exec_time = curr_time - prev_time
-        prev_time = curr_time
-        accum_time = accum_time + exec_time
-        curr_fps = curr_fps + 1
-        if accum_time > 1:
-            accum_time = accum_time - 1
-            fps = "FPS: " + str(curr_fps)
-            curr_fps = 0
-        cv2.putText(result, text=fps, org=(3, 15), fontFace=cv2.FONT_HERSHEY_SIMPLEX,
+    out = cv2.VideoWriter(output_path, video_FourCC, video_fps, video_size) if isOutput else None
+
+    stop = threading.Event()
+    failed = list()
+    latency = {'decode': [], 'preprocess': [], 'inference': [], 'encode': []}
+    decoded, prepared, detected = (queue.Queue(queue_size) for i in range(3))
+    shown = queue.Queue(queue_size) if not headless else None
+    fps = {'text': "FPS: ??", 'count': 0, 'since': timer()}
+
+    def decode():
+        while not stop.is_set() and not failed:
+            start = timer()
+            return_value, frame = vid.read()
+            if not return_value: # end of file (or camera unplugged)
+                break
+            latency['decode'].append(timer() - start)
+            decoded.put(frame)
+        decoded.put(_END)
+
+    def preprocess(frame):
+        return frame, yolo.preprocess(frame)
+
+    def inference(item):
+        frame, image_data = item
+        return frame, yolo.infer(image_data, frame.shape[:2])
+
+    def encode(item):
+        frame, (out_boxes, out_scores, out_classes) = item
+        result = yolo.renderer.draw(frame, out_boxes, out_scores, out_classes)
+        fps['count'] += 1
+        if timer() - fps['since'] > 1:
+            fps['text'] = "FPS: " + str(fps['count'])
+            fps['count'] = 0
+            fps['since'] = timer()
+        cv2.putText(result, text=fps['text'], org=(3, 15), fontFace=cv2.FONT_HERSHEY_SIMPLEX,
                     fontScale=0.50, color=(255, 0, 0), thickness=2)
-        cv2.namedWindow("result", cv2.WINDOW_NORMAL)
-        cv2.imshow("result", result)
         if isOutput:
             out.write(result)
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
+        return result
+
+    threads = [threading.Thread(target=decode, daemon=True),
+               threading.Thread(target=_stage, args=('preprocess', preprocess, decoded, prepared, latency, failed), daemon=True),
+               threading.Thread(target=_stage, args=('inference', inference, prepared, detected, latency, failed), daemon=True),
+               threading.Thread(target=_stage, args=('encode', encode, detected, shown, latency, failed), daemon=True)]
+    start = timer()
+    for t in threads:
+        t.start()
+    if not headless: # HighGUI windows belong on the main thread
+        cv2.namedWindow("result", cv2.WINDOW_NORMAL)
+        while True:
+            result = shown.get()
+            if result is _END:
+                break
+            cv2.imshow("result", result)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                stop.set()
+        cv2.destroyWindow("result")
+    for t in threads:
+        t.join()
+    elapsed = timer() - start
+    vid.release()
+    if isOutput:
+        out.release()
+    yolo.close_session()
+    if failed:
+        name, e = failed[0]
+        raise RuntimeError('detect_video: {} stage failed'.format(name)) from e
+
+    frames = len(latency['encode'])
+    stats = {'frames': frames, 'seconds': elapsed, 'fps': frames/elapsed if elapsed > 0 else 0.}
+    print('{} frames in {:.1f} s ({:.1f} frames/s)'.format(frames, elapsed, stats['fps']))
+    for name, times in latency.items():
+        times = np.array(times)*1e3
+        stats[name] = {'mean_ms': times.mean() if len(times) else 0., 'p95_ms': np.percentile(times, 95) if len(times) else 0.}
+        print('  {:<10} mean {:7.2f} ms   p95 {:7.2f} ms'.format(name, stats[name]['mean_ms'], stats[name]['p95_ms']))
+    return stats
+
+if __name__ == '__main__':
+    # Throughput of detect_batch for several batch sizes, on CPU.
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1' # before the first session is created
+    yolo = YOLO()
+    # the model input is the same as yolo3's letterbox_image gives
+    from yolo3.utils import letterbox_image
+    for name in sorted(os.listdir('images')):
+        image = Image.open(os.path.join('images', name)).convert('L').resize((1280, 1024))
+        for size in [tuple(reversed(yolo.model_image_size)), (608, 480)]:
+            assert np.array_equal(letterbox(np.asarray(image), size), np.array(letterbox_image(image, size))), name
+    frames = np.random.default_rng(0).integers(0, 256, (64, 1024, 1280), dtype='uint8')
+    yolo.detect_batch(frames[:1], batch_size=1) # warm up the graph
+    start = timer()
+    for f in frames[:16]:
+        yolo.detect_image(Image.fromarray(f))
+    print('detect_image:        {:6.2f} frames/s'.format(16/(timer() - start)))
+    for batch_size in [1, 2, 4, 8, 16, 32]:
+        start = timer()
+        yolo.detect_batch(frames, batch_size=batch_size)
+        print('detect_batch({:>2}):    {:6.2f} frames/s'.format(batch_size, len(frames)/(timer() - start)))
+    # tiled inference on full-size frames: latency per frame for each tile grid
+    for grid in [(1, 1), (2, 2), (2, 3), None]:
+        tops, lefts, th, tw = tile_frame(frames.shape[1:], yolo.model_image_size, 64, grid)
+        yolo.detect_tiled(frames[0], grid=grid)
+        start = timer()
+        for f in frames[:8]:
+            yolo.detect_tiled(f, grid=grid)
+        print('detect_tiled({}): {:2} tiles of {}x{}, {:7.1f} ms/frame'.format(
+            grid or 'model size', len(tops), tw, th, 1e3*(timer() - start)/8))
     yolo.close_session()